@@ -1,16 +1,133 @@
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from lib.model import ICUModel
+from lib.replication import ReplicationAggregator, calculate_kpis
+from lib.results import export_tables, save_results
+from lib.snapshot import save_snapshot, load_snapshot
+from lib.utils import DataManager, ICU_SPIKE_SCALE
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
 import os
 import json
+import tempfile
 import solara
 
-with open('./batch_run_config.json') as file:
-    params = json.load(file)
+# Table of the datacollector and the file it is written to for every parameter set
+TABLE_FILES = {
+    "admissions": "opnames.csv",
+    "refused": "geweigerd.csv",
+    "costs": "costs.csv",
+    "capacity": "capacity.csv",
+    "amount": "amount.csv",
+    "replanning": "replanning.csv",
+    "waiting": "waiting.csv"
+}
+
+def create_model(params: dict, seed: int = None, event_driven: bool = False, profile: bool = False, snapshot: dict = None, patient_store: bool = False) -> ICUModel:
+    # Batch runs are never drawn, so they run headless without the grid
+    arguments = dict(seed=seed,
+                    headless=True,
+                    amount=params["amount"],
+                    clock_speed=params["clock_speed"],
+                    departments=solara.reactive(params["departments"]),
+                    distribution=solara.reactive(params["distribution"]),
+                    is_specialized=solara.reactive(params["is_specialized"]),
+                    planning_method=params["planning_method"],
+                    capacity=params["capacity"],
+                    efficiency=params["efficiency"],
+                    pandemic_allocation_percentage=params["pandemic_allocation_percentage"],
+                    use_ic_spike=params["use_ic_spike"],
+                    ic_spike_scale=params.get("ic_spike_scale", ICU_SPIKE_SCALE),
+                    event_driven=event_driven,
+                    service_rate=params.get("service_rate", 1),
+                    queue_discipline=params.get("queue_discipline", "fifo"),
+                    reschedule_same_patient=params.get("reschedule_same_patient", True),
+                    profile=profile,
+                    patient_store=patient_store
+                    )
+
+    # A run from a snapshot continues from the state of the snapshot with the parameters of the set and its own seed
+    if snapshot is not None:
+        return ICUModel.from_snapshot(snapshot, **arguments)
+    return ICUModel(**arguments)
+
+@contextmanager
+def create_pool(workers: int):
+    """Starts the worker processes, they map one exported copy of the preprocessed data instead of each loading their own."""
+    with tempfile.TemporaryDirectory() as data_folder:
+        DataManager().export_data(data_folder)
+        with ProcessPoolExecutor(max_workers=workers, initializer=DataManager.attach_data, initargs=(data_folder,)) as executor:
+            yield executor
+
+def run_scenario(task: dict) -> tuple[int, int, dict, dict[str, float]]:
+    """Runs a single replication of a parameter set, this is the function executed by the worker processes."""
+    snapshot = load_snapshot(task["snapshot"]) if task["snapshot"] is not None else None
+    model = create_model(task["params"], seed=task["seed"], event_driven=task["event_driven"], profile=task["profile"], snapshot=snapshot, patient_store=task["patient_store"])
+    model.run_for_days(task["time"])
+
+    if task["format"] == "npz":
+        # The raw columns are much smaller to send back than DataFrames with a date string in every row
+        tables = export_tables(model.datacollector, list(TABLE_FILES.keys()))
+        tables["metadata"] = {
+            "params_index": task["index"],
+            "replication": task["replication"],
+            "seed": task["seed"],
+            "time": task["time"],
+            "event_driven": task["event_driven"],
+            "start_year": model.clock.start.year,
+            "params": task["params"]
+        }
+    else:
+        tables = { table: model.datacollector.get_table_dataframe(table) for table in TABLE_FILES }
+
+    if task["profile"]:
+        tables["profile"] = model.get_profile_dataframe()
+    if task["save_snapshot"]:
+        tables["snapshot"] = model.create_snapshot()
+    return task["index"], task["replication"], tables, calculate_kpis(model)
+
+def create_seeds(seed: int, scenarios: int, replications: int, common: bool = True) -> np.ndarray:
+    """
+        Derives a seed for every scenario and replication, so results don't depend on which worker runs what.
+        With common random numbers replication j of every scenario gets the same seed, so the scenarios see the same
+        arrivals and patients and differ only by their parameters. Otherwise every scenario gets independent seeds.
+    """
+    if common:
+        replication_seeds = [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(seed).spawn(replications)]
+        return np.array([replication_seeds] * scenarios)
+
+    scenario_sequences = np.random.SeedSequence(seed).spawn(scenarios)
+    return np.array([[int(sequence.generate_state(1)[0]) for sequence in scenario_sequence.spawn(replications)] for scenario_sequence in scenario_sequences])
+
+def write_results(folder: str, results: list[dict], output_format: str = "csv") -> None:
+    os.mkdir(folder)
+    if "profile" in results[0]:
+        pd.concat([result["profile"] for result in results], keys=range(len(results)), names=["replication", None]).to_csv(os.path.join(folder, "profile.csv"), sep=";")
+    for replication, result in enumerate(results):
+        if "snapshot" in result:
+            save_snapshot(os.path.join(folder, f"replication{replication}.snapshot.npz"), result["snapshot"])
+
+    if output_format == "npz":
+        # One compressed file per run, read them back with lib.results.load_results
+        for replication, result in enumerate(results):
+            save_results(os.path.join(folder, f"replication{replication}.npz"), result, result["metadata"])
+        return
+
+    for table, file in TABLE_FILES.items():
+        if len(results) == 1:
+            dataframe = results[0][table]
+        else:
+            dataframe = pd.concat([result[table] for result in results], keys=range(len(results)), names=["replication", None])
+
+        dataframe.to_csv(os.path.join(folder, file), sep=";")
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Process a time parameter.")
-    
+
     # Adding the --time argument
     parser.add_argument(
         "--time",
@@ -19,38 +136,189 @@ if __name__ == '__main__':
         help="Specify the time in days, e.g: 3."
     )
 
+    parser.add_argument(
+        "--event-driven",
+        action="store_true",
+        help="Run the models with the discrete event engine instead of stepping every agent each clock tick."
+    )
+
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="./batch_run_config.json",
+        help="Path to the json file with the parameter sets."
+    )
+
+    parser.add_argument(
+        "--replications",
+        type=int,
+        default=1,
+        help="Amount of differently seeded runs per parameter set."
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Amount of worker processes, 1 runs everything in this process."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed from which the seeds of all runs are derived, a random one is picked when omitted."
+    )
+
+    parser.add_argument(
+        "--independent-scenarios",
+        action="store_true",
+        help="Give every parameter set its own seeds, by default replication N of every parameter set uses the same seed (common random numbers)."
+    )
+
+    parser.add_argument(
+        "--precision",
+        type=float,
+        default=None,
+        help="Stop replicating a parameter set once the confidence interval half width of every KPI is at most this fraction of its mean, e.g: 0.05. --replications becomes the maximum."
+    )
+
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the intervals used by --precision."
+    )
+
+    parser.add_argument(
+        "--min-replications",
+        type=int,
+        default=3,
+        help="Amount of replications a parameter set needs before it can be stopped by --precision."
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=["csv", "npz"],
+        default="csv",
+        help="Write the tables as csv files, or as one compressed npz file per run with typed columns and the config embedded."
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time every phase of a step and every agent type (or event kind with --event-driven) and write them to profile.csv per parameter set."
+    )
+
+    parser.add_argument(
+        "--save-snapshot",
+        action="store_true",
+        help="Write the state of every run at its end to replicationN.snapshot.npz, to warm up other runs with --snapshot."
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        default=None,
+        help="Start every run from this snapshot instead of from empty beds and simulate --time days after it. The parameter sets replace the parameters of the snapshot, their department groups have to be the same."
+    )
+
+    parser.add_argument(
+        "--patient-store",
+        action="store_true",
+        help="Keep the patients in NumPy columns that are stepped as a batch instead of one agent per patient. The results are the same, it is faster when long queues build up at the front desk and slower otherwise."
+    )
+
     args = parser.parse_args()
     time = args.time
 
+    with open(args.config) as file:
+        params = json.load(file)
+
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % (2**32))
+    seeds = create_seeds(seed, len(params), args.replications, not args.independent_scenarios)
+
     if not os.path.exists("./runs"):
         os.mkdir("./runs")
 
     current_index = len(os.listdir("./runs"))
-    os.mkdir(f"./runs/run{current_index}")
-    run_datas = []
-    for i in range(len(params)):
-        os.mkdir(f"./runs/run{current_index}/params{i}")
-        opnames_file = f"./runs/run{current_index}/params{i}/opnames.csv"
-        refused_file = f"./runs/run{current_index}/params{i}/geweigerd.csv"
-        costs_file = f"./runs/run{current_index}/params{i}/costs.csv"
-        capacity_file = f"./runs/run{current_index}/params{i}/capacity.csv"
-        amount_file = f"./runs/run{current_index}/params{i}/amount.csv"
-        replanning_file = f"./runs/run{current_index}/params{i}/replanning.csv"
-        model = ICUModel(amount=params[i]["amount"], 
-                         clock_speed=params[i]["clock_speed"], 
-                         departments=solara.reactive(params[i]["departments"]), 
-                         distribution=solara.reactive(params[i]["distribution"]), 
-                         planning_method=params[i]["planning_method"],
-                         capacity=params[i]["capacity"],
-                         use_ic_spike=params[i]["use_ic_spike"]
-                         )
-       
-        for j in range(int((60*24*time)/params[i]["clock_speed"])):
-            model.step()
-
-        model.datacollector.get_table_dataframe("admissions").to_csv(opnames_file, sep=";")
-        model.datacollector.get_table_dataframe("refused").to_csv(refused_file, sep=";")
-        model.datacollector.get_table_dataframe("costs").to_csv(costs_file, sep=";")
-        model.datacollector.get_table_dataframe("capacity").to_csv(capacity_file, sep=";")
-        model.datacollector.get_table_dataframe("amount").to_csv(amount_file, sep=";")
-        model.datacollector.get_table_dataframe("replanning").to_csv(replanning_file, sep=";")
+    run_folder = f"./runs/run{current_index}"
+    os.mkdir(run_folder)
+
+    pd.DataFrame([{ "params": i, "replication": j, "seed": seeds[i][j] } for i in range(len(params)) for j in range(args.replications)]).to_csv(f"{run_folder}/seeds.csv", sep=";", index=False)
+    print(f"Running {len(params)} parameter sets x {args.replications} replications with seed {seed} in {run_folder}")
+
+    # Replication major order, so every parameter set gets its first replications before any set gets many
+    tasks = deque([{
+        "index": i,
+        "replication": j,
+        "params": params[i],
+        "seed": int(seeds[i][j]),
+        "time": time,
+        "event_driven": args.event_driven,
+        "format": args.format,
+        "profile": args.profile,
+        "snapshot": args.snapshot,
+        "save_snapshot": args.save_snapshot,
+        "patient_store": args.patient_store
+    } for j in range(args.replications) for i in range(len(params))])
+
+    results = [[None] * args.replications for _ in range(len(params))]
+    aggregators = [ReplicationAggregator(args.confidence, args.precision, args.min_replications) for _ in range(len(params))]
+    started = [0] * len(params)
+    finished = [False] * len(params)
+
+    progress = tqdm(total=len(tasks), desc="Runs")
+
+    def next_task() -> dict:
+        while len(tasks) > 0:
+            task = tasks.popleft()
+            if not finished[task["index"]]:
+                started[task["index"]] += 1
+                return task
+        return None
+
+    def collect_result(index: int, replication: int, tables: dict[str, pd.DataFrame], kpis: dict[str, float]) -> None:
+        progress.update(1)
+        if finished[index]:
+            return
+
+        results[index][replication] = (tables, kpis)
+
+        # Results are aggregated in replication order, so where a parameter set stops doesn't depend on worker timing
+        aggregator = aggregators[index]
+        while aggregator.count < args.replications and results[index][aggregator.count] is not None:
+            aggregator.add(results[index][aggregator.count][1])
+
+            if aggregator.is_converged() or aggregator.count == args.replications:
+                finished[index] = True
+                progress.total -= args.replications - started[index]
+                progress.refresh()
+
+                # Write a parameter set as soon as it is done, so memory doesn't pile up
+                folder = f"{run_folder}/params{index}"
+                write_results(folder, [x[0] for x in results[index][:aggregator.count]], args.format)
+                if args.replications > 1:
+                    aggregator.get_summary_dataframe().to_csv(os.path.join(folder, "summary.csv"), sep=";", index=False)
+                results[index] = None
+                break
+
+    if args.workers <= 1:
+        while (task := next_task()) is not None:
+            collect_result(*run_scenario(task))
+    else:
+        with create_pool(args.workers) as executor:
+            running = set()
+            while True:
+                while len(running) < args.workers and (task := next_task()) is not None:
+                    running.add(executor.submit(run_scenario, task))
+
+                if len(running) == 0:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect_result(*future.result())
+
+    progress.close()
+    print("Replications per parameter set:", [x.count for x in aggregators])
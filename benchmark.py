@@ -0,0 +1,335 @@
+import argparse
+from batch_run import create_model
+from lib.datacollection import ColumnarDataCollector
+from lib.model import ICUModel
+from lib.utils import DataManager
+import pandas as pd
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+# Bump when the layout of the benchmark file changes
+BENCHMARK_VERSION = 1
+
+# Metrics where a higher value is better, for all other metrics lower is better
+HIGHER_IS_BETTER = {"steps_per_second"}
+
+# Metrics that aren't timings, these aren't scaled by the calibration
+UNTIMED = {"peak_memory_mb"}
+
+# Timed runs and timings per component of a scenario in every round
+ROUND_REPEAT = 3
+
+# Components that take less seconds per call than this are reported but don't fail the comparison, timer noise is
+# as large as they are
+GATE_MINIMUM_SECONDS = 1e-6
+
+
+def get_layout_name(params: dict) -> str:
+    return " | ".join(", ".join(specs) for specs in params["departments"])
+
+def create_matrix(config: list[dict], amounts: list[int] = None, capacities: list[int] = None, clock_speeds: list[int] = None) -> list[dict]:
+    """
+        Every department layout of the config crossed with the given amounts, capacities and clock speeds.
+        Values that aren't given are taken from the config entries of the layout, the other parameters from its first entry.
+    """
+    layouts = {}
+    for params in config:
+        layout = json.dumps([params["departments"], params["distribution"], params["is_specialized"]])
+        layouts.setdefault(layout, []).append(params)
+
+    matrix = []
+    for entries in layouts.values():
+        values = itertools.product(
+            amounts or sorted({x["amount"] for x in entries}),
+            capacities or sorted({x["capacity"] for x in entries}),
+            clock_speeds or sorted({x["clock_speed"] for x in entries})
+        )
+        for amount, capacity, clock_speed in values:
+            matrix.append({ **entries[0], "amount": amount, "capacity": capacity, "clock_speed": clock_speed })
+
+    return matrix
+
+def get_scenario_key(params: dict, event_driven: bool) -> str:
+    """Identifies a scenario across benchmark files, so a run can be compared against a baseline."""
+    mode = "event" if event_driven else "stepped"
+    return (f"{mode} | {get_layout_name(params)} | distribution={params['distribution']} specialized={params['is_specialized']} "
+            f"| amount={params['amount']} capacity={params['capacity']} clock_speed={params['clock_speed']}")
+
+def time_call(function, repeat: int, number: int) -> float:
+    """Seconds per call, the best of repeat timings of number calls."""
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def measure_agent_steps(model: ICUModel, repeat: int) -> dict[str, float]:
+    """
+        Seconds per step of the front desk and a department. Their steps change the state they work on, the queue empties
+        and the due discharges are gone after a call, so they are timed over a day of normal steps. Every repeat runs the
+        same day from a snapshot of the model.
+    """
+    snapshot = model.create_snapshot()
+    timings = { "Frontdesk": [], "Department": [] }
+    for _ in range(repeat):
+        profiled = ICUModel.from_snapshot(snapshot, profile=True, event_driven=False)
+        profiled.run_for_days(1)
+        profile = profiled.get_profile_dataframe().set_index(["category", "name"])
+        for name, values in timings.items():
+            values.append(profile.loc[("agent", name), "mean_seconds"])
+
+    return { "frontdesk_step": min(timings["Frontdesk"]), "department_step": min(timings["Department"]) }
+
+def measure_components(params: dict, seed: int, event_driven: bool, warmup_days: int, repeat: int) -> dict[str, float]:
+    """Seconds per call of the parts of a step, measured on a model that has run for a few days so it holds patients."""
+    model = create_model(params, seed=seed, event_driven=event_driven)
+    model.run_for_days(warmup_days)
+
+    datamanager = model.datamanager
+
+    # Writes go to a collector of their own, so the tables of the model stay as they were
+    collector = ColumnarDataCollector(tables={ "refused": { "date": "time", "ref_spec": "category" } }, time_formatter=model.clock.format_time)
+
+    return {
+        # Without the caches, a cache hit only looks up the data of the process
+        "datamanager_construction": time_call(lambda: DataManager(use_cache=False), repeat, 3),
+        "datamanager_amount_percentage_by_day": time_call(lambda: datamanager.get_amount_percentage_by_day(180, True), repeat, 10000),
+        "datamanager_mean_std_by_planned": time_call(lambda: datamanager.get_mean_std_by_planned(False), repeat, 10000),
+        "datamanager_icu_spike_by_day": time_call(lambda: datamanager.get_icu_spike_by_day(180), repeat, 1000),
+        "create_patients_256": time_call(lambda: datamanager.create_patients(256), repeat, 100),
+        **measure_agent_steps(model, repeat),
+        "datacollector_add_table_row": time_call(lambda: collector.add_table_row("refused", { "date": 0, "ref_spec": "CAPU" }), repeat, 10000),
+        "datacollector_collect": time_call(lambda: model.datacollector.collect(model), repeat, 1000)
+    }
+
+def measure_calibration(repeat: int) -> float:
+    """Seconds of a fixed pure Python loop, how fast the machine is at the moment a scenario is timed."""
+    return time_call(lambda: sum([i * i for i in range(10000)]), repeat, 20)
+
+def measure_peak_memory(params: dict, seed: int, event_driven: bool, days: int) -> float:
+    """Peak of the memory allocated by Python while constructing and running the model, in MB."""
+    tracemalloc.start()
+    try:
+        model = create_model(params, seed=seed, event_driven=event_driven)
+        model.run_for_days(days)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024 ** 2
+
+def benchmark_scenario(params: dict, seed: int, event_driven: bool, days: int, repeat: int, memory: bool = True, components: bool = True) -> dict:
+    calibration = measure_calibration(repeat)
+    construction_times = []
+    run_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model = create_model(params, seed=seed, event_driven=event_driven)
+        construction_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        model.run_for_days(days)
+        run_times.append(time.perf_counter() - start)
+
+    # The best of the repeats is the least disturbed by other processes on the machine
+    run_time = min(run_times)
+    steps = days * model.clock.seconds_in_day / model.clock.clock_speed
+    metrics = {
+        "construction_seconds": min(construction_times),
+        "run_seconds": run_time,
+        "steps_per_second": steps / run_time,
+        "seconds_per_simulated_year": run_time / days * 365
+    }
+
+    if memory:
+        metrics["peak_memory_mb"] = measure_peak_memory(params, seed, event_driven, days)
+
+    result = {
+        "key": get_scenario_key(params, event_driven),
+        "params": params,
+        "event_driven": event_driven,
+        "days": days,
+        "calibration_seconds": calibration,
+        "metrics": metrics
+    }
+    if components:
+        result["components"] = measure_components(params, seed, event_driven, min(days, 7), repeat)
+
+    return result
+
+def merge_rounds(results: list[dict]) -> dict:
+    """The best value of every metric over the results of one scenario from several rounds."""
+    def best(metric: str, values: list[float]) -> float:
+        return max(values) if metric in HIGHER_IS_BETTER else min(values)
+
+    merged = { **results[0], "calibration_seconds": min([result["calibration_seconds"] for result in results]) }
+    for group in ["metrics", "components"]:
+        if group in merged:
+            names = dict.fromkeys(name for result in results for name in result[group])
+            merged[group] = { name: best(name, [result[group][name] for result in results if name in result[group]]) for name in names }
+
+    return merged
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten_metrics(result: dict) -> dict[str, float]:
+    return { **result["metrics"], **{ f"components.{name}": value for name, value in result.get("components", {}).items() } }
+
+def compare_results(baseline: dict, current: dict, tolerance: float = 0.1) -> pd.DataFrame:
+    """
+        Compares every metric of the scenarios both benchmark files contain. The change is the relative change of the metric
+        in the direction where positive is slower or larger, a change above tolerance is marked as a regression.
+        Components below GATE_MINIMUM_SECONDS per call in both files are compared but never marked.
+        Timings are scaled by the calibration of the scenario in both files, so a machine that is slower as a whole,
+        or busy while one of the files was made, doesn't show up as a regression.
+    """
+    baseline_results = { result["key"]: (flatten_metrics(result), result.get("calibration_seconds")) for result in baseline["results"] }
+
+    rows = []
+    for result in current["results"]:
+        if result["key"] not in baseline_results:
+            continue
+
+        baseline_metrics, baseline_calibration = baseline_results[result["key"]]
+        calibration = result.get("calibration_seconds")
+        speed = baseline_calibration / calibration if baseline_calibration and calibration else 1.0
+
+        for metric, value in flatten_metrics(result).items():
+            baseline_value = baseline_metrics.get(metric)
+            if baseline_value is None or baseline_value == 0:
+                continue
+
+            if metric not in UNTIMED:
+                value = value / speed if metric in HIGHER_IS_BETTER else value * speed
+            change = value / baseline_value - 1
+            if metric in HIGHER_IS_BETTER:
+                change = baseline_value / value - 1
+            gated = not metric.startswith("components.") or max(value, baseline_value) >= GATE_MINIMUM_SECONDS
+            rows.append({
+                "scenario": result["key"],
+                "metric": metric,
+                "baseline": baseline_value,
+                "current": value,
+                "change": change,
+                "regression": gated and change > tolerance
+            })
+
+    return pd.DataFrame(rows, columns=["scenario", "metric", "baseline", "current", "change", "regression"])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the ICUModel over a matrix of parameter sets.")
+
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="./batch_run_config.json",
+        help="Path to the json file with the parameter sets, every department layout in it is benchmarked."
+    )
+
+    parser.add_argument("--amount", type=int, nargs="+", default=None, help="Amounts of patients per year to benchmark, e.g: 2200 4500.")
+    parser.add_argument("--capacity", type=int, nargs="+", default=None, help="Capacities to benchmark, e.g: 16 32 64.")
+    parser.add_argument("--clock-speed", type=int, nargs="+", default=None, help="Clock speeds in minutes to benchmark, e.g: 1 10.")
+
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=14,
+        help="Amount of simulated days per run, the time per simulated year is extrapolated from it."
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help=f"Amount of rounds through all scenarios, every round times {ROUND_REPEAT} runs and every component of a scenario. The best one is reported."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Seed of every run, so every benchmark simulates the same patients."
+    )
+
+    parser.add_argument(
+        "--event-driven",
+        action="store_true",
+        help="Benchmark the discrete event engine instead of stepping every agent each clock tick."
+    )
+
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory run, which is slow because every allocation is traced.")
+    parser.add_argument("--no-components", action="store_true", help="Skip timing the separate parts of a step.")
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./benchmark.json",
+        help="Path of the json file the results are written to."
+    )
+
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Path of an earlier benchmark file to compare against, exits with 1 when a metric regressed."
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Fraction a metric may get worse compared to the baseline before it counts as a regression."
+    )
+
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        config = json.load(file)
+
+    matrix = create_matrix(config, args.amount, args.capacity, args.clock_speed)
+    print(f"Benchmarking {len(matrix)} scenarios of {args.days} days")
+
+    # The repeats are spread over rounds through all scenarios instead of done back to back, so a slow stretch of the
+    # machine slows one round of every scenario and the best round of each is still undisturbed
+    rounds = []
+    for i in range(args.repeat):
+        rounds.append([benchmark_scenario(params, args.seed, args.event_driven, args.days, ROUND_REPEAT, not args.no_memory and i == 0, not args.no_components) for params in matrix])
+
+    results = [merge_rounds(list(x)) for x in zip(*rounds)]
+    for result in results:
+        print(f"{result['key']}: {result['metrics']['steps_per_second']:.0f} steps/s, {result['metrics']['seconds_per_simulated_year']:.2f} s per simulated year")
+
+    benchmark = {
+        "version": BENCHMARK_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": get_git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": { "days": args.days, "repeat": args.repeat, "seed": args.seed, "event_driven": args.event_driven },
+        "results": results
+    }
+
+    with open(args.output, "w") as file:
+        json.dump(benchmark, file, indent=2, default=str)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        comparison = compare_results(baseline, benchmark, args.tolerance)
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(comparison.to_string(index=False))
+
+        regressions = comparison[comparison["regression"]]
+        if len(regressions) > 0:
+            print(f"{len(regressions)} metrics regressed more than {args.tolerance:.0%}")
+            sys.exit(1)
+        print("No regressions")
@@ -1,8 +1,11 @@
 from mesa import Agent
 from typing import List
 import numpy as np
+import heapq
+
+# Bed types, stored as their index in the bed_types array
+BED_TYPES = ["normal", "pandemic"]
 
-#TODO: Create allocating capacity functions
 class Department(Agent):
     def __init__(self, model, specs: List[str], capacity: int = 32, is_specialized: bool = False) -> None:
         super().__init__(model)
@@ -11,46 +14,86 @@ class Department(Agent):
         self.capacity = capacity
         self.is_specialized = is_specialized
         self.current_capacity = capacity
+        # Admitted patients by the moment they leave, (discharge_at, unique_id, patient)
+        self.discharges = []
 
-        self.beds = {}
         self.allocate_capacity()
 
     def allocate_capacity (self):
+        """
+            Creates the bed store: the type and occupant of every bed in arrays, a free list per bed type and a map from
+            patient to bed, so allocating, freeing and counting beds never has to look at all beds.
+        """
         pandemic_capacity = int(self.model.pandemic_allocation_percentage * self.capacity)
         normal_capacity = self.capacity - pandemic_capacity
 
-        for i in range(normal_capacity):
-            self.beds[i] = {
-                "type": "normal",
-                "patient": None
-            }
-
-        for i in range(pandemic_capacity):
-            self.beds[i] = {
-                "type": "pandemic",
-                "patient": None
-            }
-
-    # def update_capacity (self):
-    #     self.patients = [x for x in self.model.space.get_cell_list_contents([self.pos]) if type(x) != Department and x not in [v["patient"] for v in self.beds.values()]]
+        self.bed_types = np.array([BED_TYPES.index("normal")] * normal_capacity + [BED_TYPES.index("pandemic")] * pandemic_capacity, dtype=np.int8)
+        self.bed_occupants = np.full(len(self.bed_types), -1)
+        self.free_beds = {
+            "normal": list(range(normal_capacity)),
+            "pandemic": list(range(normal_capacity, len(self.bed_types)))
+        }
+        self.patient_beds = {}
+        self.current_capacity = len(self.bed_types)
 
-    #     for patient in self.patients:
-            
+    def get_bed_type_order (self, patient) -> List[str]:
+        # Pandemic patients fill the pandemic beds first, the pandemic beds are kept free for them
+        return ["pandemic", "normal"] if getattr(patient, "bed_type", "normal") == "pandemic" else ["normal"]
 
-        
+    def has_free_bed (self, patient) -> bool:
+        return any([len(self.free_beds[bed_type]) > 0 for bed_type in self.get_bed_type_order(patient)])
 
     def free_capacity (self, patient):
-        for key in self.beds.keys():
-            if self.beds[key]["patient"] == patient:
-                self.beds[key]["patient"] = None
+        bed = self.patient_beds.pop(patient.unique_id, None)
+        if bed is None:
+            return
+
+        self.bed_occupants[bed] = -1
+        self.free_beds[BED_TYPES[self.bed_types[bed]]].append(bed)
+        self.current_capacity += 1
 
     def allocate_patient_location (self, patient) -> None:
-        choices = [key for key in self.beds.keys() if self.beds[key]["patient"] == None]
-            
-        key = (self.model.random.choice(choices)) #TODO: add condition for when self.beds[key]["type"] equals patient.type (which can either be normal or pandemic)
-        self.beds[key]["patient"] = patient
+        for bed_type in self.get_bed_type_order(patient):
+            free_beds = self.free_beds[bed_type]
+            if len(free_beds) > 0:
+                break
+
+        # Pick a random free bed and swap it with the last one, so it can be popped in constant time
+        index = int(self.model.streams["beds"].integers(len(free_beds)))
+        free_beds[index], free_beds[-1] = free_beds[-1], free_beds[index]
+        bed = free_beds.pop()
+
+        self.bed_occupants[bed] = patient.unique_id
+        self.patient_beds[patient.unique_id] = bed
+        self.current_capacity -= 1
+
+    def get_los_rate (self) -> int:
+        """Seconds of length of stay a patient in the department counts down every step, specialized departments are faster."""
+        clock_speed = self.model.clock.clock_speed
+        return clock_speed + int(clock_speed * self.model.efficiency) if self.is_specialized else clock_speed
+
+    def get_time_until_discharge (self, los_icu, admitted: bool = False):
+        """
+            Seconds from now until the step in which the department has counted down los_icu, los_icu can be an array.
+            The stay of a patient that is admitted now is counted from this step on, the rest of the stay of a patient
+            that is already admitted from the next step on.
+        """
+        steps = -(-los_icu // self.get_los_rate())
+        if not admitted:
+            steps = np.maximum(steps - 1, 0)
+        return steps * self.model.clock.clock_speed
+
+    def schedule_discharge (self, patient) -> None:
+        heapq.heappush(self.discharges, (patient.discharge_at, patient.unique_id, patient))
+
+    def discharge_due_patients (self) -> None:
+        """
+            Discharges the patients whose stay is over, the other admitted patients aren't touched. Patients that leave at
+            the same moment go in the order they were created, the order the patients used to be stepped in.
+        """
+        elapsed = self.model.clock.elapsed
+        while len(self.discharges) > 0 and self.discharges[0][0] <= elapsed:
+            heapq.heappop(self.discharges)[2].discharge()
 
     def step(self) -> None:
-        self.current_capacity = len([x for x in self.beds.values() if x["patient"] == None])
-        # self.update_capacity()
-        return super().step()
\ No newline at end of file
+        self.discharge_due_patients()
@@ -1,9 +1,10 @@
 from mesa import Agent
-import numpy as np
+from itertools import count
+import heapq
 from .patient import Patient
 
 class Frontdesk(Agent):
-    def __init__(self, model, pos: tuple[int, int], planning_method: int):
+    def __init__(self, model, pos: tuple[int, int], planning_method: int, service_rate: int = 1, queue_discipline: str = "fifo"):
         super().__init__(model)
         self.row_pos = (pos[0], pos[1] - 1)
         self.planning_method = planning_method
@@ -13,73 +14,118 @@ class Frontdesk(Agent):
             3: self.reschedule_patient_lowest
         }
 
+        # Patients waiting in line, "fifo" helps them in order of arrival and "priority" helps unplanned patients first
+        self.service_rate = service_rate
+        self.queue_discipline = queue_discipline
+        self.queue = []
+        self.queue_counter = count()
+
+    def enqueue(self, patient: Patient) -> None:
+        priority = int(patient.planned) if self.queue_discipline == "priority" else 0
+        patient.queued_at = self.model.clock.elapsed
+        heapq.heappush(self.queue, (priority, next(self.queue_counter), patient))
+
+    def dequeue(self) -> Patient:
+        _, _, patient = heapq.heappop(self.queue)
+        self.model.datacollector.add_table_row("waiting", { "date": self.model.clock.elapsed, "ref_spec": patient.spec, "plan_adm": patient.planned, "wait_time": self.model.clock.elapsed - patient.queued_at })
+        return patient
+
+    def serve(self) -> list[Patient]:
+        """Helps up to service_rate patients from the queue and returns the ones that got a bed."""
+        admitted = []
+        for _ in range(min(self.service_rate, len(self.queue))):
+            patient = self.dequeue()
+            if self.handle_patient(patient) is not None:
+                admitted.append(patient)
+
+        return admitted
+
     def step(self) -> None:
-        in_front = [x for x in self.model.space.get_cell_list_contents([self.row_pos]) if type(x) == Patient]
-        if len(in_front) > 0:
-            patient: Patient = sorted(in_front, key=lambda a: a.unique_id)[0]
-            if patient is not None:
-                # Get the department based on the spec
-                department = self.model.get_icu_department(patient.spec)
-
-                if department is not None and department.current_capacity > 0:
-                    # There is space, assign the patient to the department
-                    department.allocate_patient_location(patient)
-                    patient.set_icu_department(department)
-
-                # No space
-                else:
-                    # Check if patient is planned
-                    if patient.planned:
-                        self.function_dict[self.planning_method](patient)
-                        self.model.datacollector.add_table_row("replanning", {"date": self.model.clock.get_time(True), "planning_method": self.planning_method })
-                    else:
-                        self.model.datacollector.add_table_row("refused", { "ref_spec": patient.spec, "date": self.model.clock.get_time(True) })
-                        self.deny_patient(patient)
+        self.serve()
+
+    def handle_patient(self, patient: Patient):
+        """Admits the patient to its department when there is space, otherwise replans or refuses the patient. Returns the department on admission."""
+        # Get the department based on the spec
+        department = self.model.get_icu_department(patient.spec)
+
+        if department is not None and department.has_free_bed(patient):
+            # There is space, assign the patient to the department
+            department.allocate_patient_location(patient)
+            patient.set_icu_department(department)
+            return department
 
+        # No space
+        # Check if patient is planned
+        if patient.planned:
+            day = self.function_dict[self.planning_method](patient)
+            self.model.datacollector.add_table_row("replanning", {"date": self.model.clock.elapsed, "planning_method": self.planning_method })
+            if self.model.engine is not None:
+                self.model.engine.on_rescheduled(day)
+        else:
+            self.model.datacollector.add_table_row("refused", { "ref_spec": patient.spec, "date": self.model.clock.elapsed })
+            self.deny_patient(patient)
+
+        return None
+
+    def get_rescheduled_data(self, patient: Patient):
+        return patient.get_data() if self.model.reschedule_same_patient else None
+
+    def plan_arrival(self, day: int, patient: Patient) -> None:
+        """Plans the patient on a day of this year, days after its last day are days of the next year."""
+        schedule = self.model.agent_schedules
+        if day > schedule.days:
+            day -= schedule.days
+            schedule = self.model.next_agent_schedules
+        schedule.insert(day, self.model.clock.get_day_timestamp(), self.get_rescheduled_data(patient))
+
+    def count_planned_arrivals(self, day: int) -> int:
+        """Planned arrivals still to come on a day, the next year's are its planned patients and the ones replanned into it."""
+        days = self.model.agent_schedules.days
+        if day <= days:
+            return self.model.agent_schedules.count(day)
+
+        day -= days
+        return int(self.model.amount * self.model.datamanager.get_amount_percentage_by_day(day, True)) + self.model.next_agent_schedules.count(day)
 
     def reschedule_patient_24(self, patient: Patient):
         """Reschedule a planned patient for a day later."""
         patient.remove()
-        self.model.space.remove_agent(patient)
+        if self.model.space is not None:
+            self.model.space.remove_agent(patient)
         index = self.model.clock.day_index + 1
-        if(self.model.clock.day_index + 1 > 365):
-            index = 1       
-        self.model.agent_schedules[index] = np.sort(
-            np.concatenate((self.model.agent_schedules[index], [self.model.clock.get_day_timestamp()]))
-        )
+        self.plan_arrival(index, patient)
+        return index
 
     def reschedule_patient_random(self, patient: Patient):
         """Reschedule a planned patient to a random future day within 1-2 weeks."""
         patient.remove()
-        self.model.space.remove_agent(patient) 
+        if self.model.space is not None:
+            self.model.space.remove_agent(patient) 
 
         # Rescheduling takes place between a day and two weeks later
         min_day = self.model.clock.day_index + 1
         max_day = self.model.clock.day_index + 14  
 
 
-        random_day = np.random.randint(min_day, max_day + 1)
-        random_day = random_day if random_day <= 365 else random_day - 365
-
-        self.model.agent_schedules[random_day] = np.sort(
-            np.concatenate([self.model.agent_schedules[random_day], [self.model.clock.get_day_timestamp()]])
-        )
+        random_day = int(self.model.streams["rescheduling"].integers(min_day, max_day + 1))
+        self.plan_arrival(random_day, patient)
+        return random_day
 
 
     def reschedule_patient_lowest(self, patient: Patient):
         """Reschedule a planned patient to the day with the least planned appointments within the current week."""
         patient.remove()
-        self.model.space.remove_agent(patient)
+        if self.model.space is not None:
+            self.model.space.remove_agent(patient)
 
         current_week = range(self.model.clock.day_index, self.model.clock.day_index + 7)
         # Find the day with the least scheduled appointments
-        min_day = min(current_week, key=lambda day: len(self.model.agent_schedules.get(day if day <= 365 else day - 365, [])))
-        min_day = min_day if min_day <= 365 else min_day - 365
-        self.model.agent_schedules[min_day] = np.sort(
-            np.concatenate([self.model.agent_schedules[min_day], [self.model.clock.get_day_timestamp()]])
-        )
+        min_day = min(current_week, key=self.count_planned_arrivals)
+        self.plan_arrival(min_day, patient)
+        return min_day
         
     def deny_patient(self, patient: Patient):
         """Deny an unplanned patient and simulate redirection."""
         patient.remove()
-        self.model.space.remove_agent(patient)  
+        if self.model.space is not None:
+            self.model.space.remove_agent(patient)  
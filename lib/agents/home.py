@@ -1,5 +1,4 @@
 from mesa import Agent
-import numpy as np
 from typing import Callable
 
 class Home(Agent):
@@ -7,35 +6,23 @@ class Home(Agent):
         super().__init__(model)
         self.create_agent = create_agent
         self.current_day = -1
-        self.spawn_timestamps = []
 
-    def step(self) -> None:
-        if(self.model.clock.day_index is not self.current_day):
-            
-            self.current_day = self.model.clock.day_index
-            percentage = self.model.datamanager.get_amount_percentage_by_day(self.current_day, False)
-            amount_of_agents_today = int(self.model.amount * percentage)
-            if(self.model.use_ic_spike):
-                amount_of_agents_today += self.model.datamanager.get_icu_spike_by_day((self.model.clock.year - 25) * 365 + self.model.clock.day_index)
-            
-            self.spawn_timestamps = np.sort(self.model.get_normally_distributed_timestamps(amount_of_agents_today, False))
-            self.model.datacollector.add_table_row("amount", { "date": self.model.clock.get_time(True), "admissions": len(self.spawn_timestamps) + len(self.model.agent_schedules[self.current_day]) })
-        
-        if(len(self.spawn_timestamps) > 0):
-            current_timestamp = self.spawn_timestamps[0]
-            
-            if(self.model.clock.get_day_timestamp() >= current_timestamp):
-                # Unplanned
-                self.create_agent(False)
-                self.spawn_timestamps = np.delete(self.spawn_timestamps, 0)
+    def start_day(self) -> None:
+        """Starts the day that just began, the model already switched to the schedules of a new year."""
+        self.current_day = self.model.clock.day_index
+        self.model.datacollector.add_table_row("amount", { "date": self.model.clock.elapsed, "admissions": self.model.unplanned_schedules.count(self.current_day) + self.model.agent_schedules.count(self.current_day) })
+
+    def release_arrivals(self) -> list:
+        """Creates every patient whose arrival is due, unplanned patients first, and returns them."""
+        timestamp = self.model.clock.get_day_timestamp()
+        patients = [self.create_agent(False, pandemic) for pandemic in self.model.unplanned_schedules.release(self.current_day, timestamp)]
+        # Replanned patients come back with their own attributes, the others are drawn
+        patients += [self.create_agent(True, data=data) for data in self.model.agent_schedules.release(self.current_day, timestamp)]
+        return patients
 
-        if(len(self.model.agent_schedules[self.current_day]) > 0):
-            current_timestamp = self.model.agent_schedules[self.current_day][0]
-            
-            if(self.model.clock.get_day_timestamp() >= current_timestamp):
-                # Planned agent
-                self.create_agent(True)
-                self.model.agent_schedules[self.current_day] = np.delete(self.model.agent_schedules[self.current_day], 0)
+    def step(self) -> None:
+        if(self.model.clock.day_index != self.current_day):
+            self.start_day()
 
+        self.release_arrivals()
         return super().step()
-        
\ No newline at end of file
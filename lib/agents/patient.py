@@ -1,11 +1,16 @@
 from mesa import Agent
-import numpy as np
 # from lib.utils import get_amount_percentage_by_day
 
+# States of a patient, these drive the patient instead of its position so the model also runs without a grid
+WAITING = "waiting"
+AT_DESK = "at_desk"
+AT_DEPARTMENT = "at_department"
+ADMITTED = "admitted"
+
 class Patient(Agent): 
-    def __init__(self, model, age: int, gender: str, planned: bool, spec: str, los_icu: float) -> None:
+    def __init__(self, model, age: int, gender: str, planned: bool, spec: str, los_icu: float, bed_type: str = "normal") -> None:
         super().__init__(model)
-        self.sickness = np.random.rand()
+        self.sickness = model.streams["sickness"].random()
         self.is_in_icu = False
         self.icu_department = None
         self.adm_icu = None
@@ -15,7 +20,12 @@ class Patient(Agent):
         self.spec = spec
         self.los_icu = int(los_icu * (24 * 3600))
         self.backup_los_icu = los_icu
-        
+        self.bed_type = bed_type
+        self.queued_at = None
+        self.discharge_at = None
+        self.state = WAITING
+        # Admitted patients are left to their department, only the others are stepped
+        model.patients_in_transit[self] = None
 
     def move(self, location: tuple[int, int]) -> None:
         # neighbors: Sequence[tuple[int, int]]  = self.model.space.get_neighborhood(self.pos, moore=False, include_center=True, radius=1)
@@ -31,32 +41,59 @@ class Patient(Agent):
         #         closest = distance
         #         target = neighbor
 
-        self.model.space.move_agent(self, location)
+        if self.model.space is not None:
+            self.model.space.move_agent(self, location)
+
+    def go_to_front_desk(self) -> None:
+        self.move(self.model.get_front_desk_location())
+        self.state = AT_DESK
+        self.model.get_front_desk().enqueue(self)
+
+    def go_to_department(self) -> None:
+        self.move(self.icu_department.pos)
+        self.state = AT_DEPARTMENT
     
+    def get_data(self) -> dict:
+        """The attributes of the patient in the form the patient sampler draws them, used to replan the same patient."""
+        return { "ref_spec": self.spec, "age": self.age, "gender": self.gender, "los_icu": self.backup_los_icu }
+
     def set_icu_department(self, department) -> None:
         self.icu_department = department
 
-    def step(self) -> None:
-        if(self.icu_department is not None):
-            if(self.icu_department.pos == self.pos and not self.is_in_icu ):
-                self.adm_icu = self.model.clock.get_time(True)
-                self.is_in_icu = True
-
-        if(not self.is_in_icu and self.icu_department is None):
-            self.move(self.model.get_front_desk_location())
-        elif(not self.is_in_icu and self.icu_department is not None): 
-            self.move(self.icu_department.pos)
-
-        if(self.is_in_icu):
-            if(self.icu_department.is_specialized):
-                self.los_icu -= self.model.clock.clock_speed + int(self.model.clock.clock_speed * self.model.efficiency)
-            else:
-                self.los_icu -= self.model.clock.clock_speed
-                
-        if(self.los_icu <= 0):
-            if(self.icu_department == None):
-                print("dit kan helemaal niet", self.los_icu, self.backup_los_icu)
-            self.model.datacollector.add_table_row("admissions", { "ref_spec": self.spec, "adm_icu": self.adm_icu, "dis_icu": self.model.clock.get_time(True), "los_icu": self.backup_los_icu, "age": self.age, "gender": self.gender, "plan_adm": self.planned })
-            self.icu_department.free_capacity(self)
-            self.remove()
+    def admit(self) -> None:
+        """
+            Admits the patient and works out when it leaves. A stay that ends in the step of the admission is left to the
+            caller, any other stay is handed to the department which discharges the patient once it's due.
+        """
+        self.adm_icu = self.model.clock.elapsed
+        self.is_in_icu = True
+        self.state = ADMITTED
+        self.discharge_at = self.adm_icu + self.get_time_until_discharge()
+        self.model.patients_in_transit.pop(self, None)
+        if self.discharge_at > self.adm_icu:
+            self.icu_department.schedule_discharge(self)
+
+    def get_time_until_discharge(self) -> int:
+        """Returns the seconds between admission and the step in which the length of stay has been counted down."""
+        return int(self.icu_department.get_time_until_discharge(self.los_icu))
+
+    def discharge(self) -> None:
+        self.model.datacollector.add_table_row("admissions", { "ref_spec": self.spec, "adm_icu": self.adm_icu, "dis_icu": self.model.clock.elapsed, "los_icu": self.backup_los_icu, "age": self.age, "gender": self.gender, "plan_adm": self.planned })
+        self.icu_department.free_capacity(self)
+        self.remove()
+        if self.model.space is not None:
             self.model.space.remove_agent(self)
+
+    def remove(self) -> None:
+        self.model.patients_in_transit.pop(self, None)
+        super().remove()
+
+    def step(self) -> None:
+        if(self.state == AT_DEPARTMENT):
+            self.admit()
+            if(self.discharge_at <= self.model.clock.elapsed):
+                self.discharge()
+        elif(self.state == WAITING):
+            self.go_to_front_desk()
+        elif(self.state == AT_DESK and self.icu_department is not None): 
+            self.go_to_department()
@@ -0,0 +1,164 @@
+from mesa.datacollection import DataCollector
+from functools import partial
+from typing import Callable
+import types
+import numpy as np
+import pandas as pd
+
+# Amount of rows a column has room for before it grows, a full column doubles its size
+INITIAL_COLUMN_SIZE = 1024
+
+
+def format_times(values: np.ndarray, formatter: Callable[[int], str]) -> np.ndarray:
+    """Formats elapsed seconds to dates, many rows share a moment so every moment is only formatted once."""
+    moments, inverse = np.unique(values, return_inverse=True)
+    return np.array([formatter(int(x)) for x in moments], dtype=object)[inverse].reshape(-1)
+
+def decode_categories(codes: np.ndarray, categories: list) -> np.ndarray:
+    return np.array(categories, dtype=object)[codes]
+
+
+class Column:
+    """Typed numpy buffer that grows by doubling, so appending a value doesn't create a Python object per row."""
+    def __init__(self, dtype = object, size: int = INITIAL_COLUMN_SIZE) -> None:
+        self.values = np.empty(size, dtype=dtype)
+        self.size = 0
+
+    def append(self, value) -> None:
+        if self.size == len(self.values):
+            self.values = np.concatenate((self.values, np.empty(len(self.values), dtype=self.values.dtype)))
+
+        self.values[self.size] = value
+        self.size += 1
+
+    def get_values(self) -> np.ndarray:
+        """The stored values as they are kept in memory."""
+        return self.values[:self.size]
+
+    def to_array(self) -> np.ndarray:
+        """The values as they appear in the DataFrame."""
+        return self.get_values().copy()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index):
+        return self.get_values()[index]
+
+    def __iter__(self):
+        return iter(self.get_values())
+
+
+class CategoryColumn(Column):
+    """Stores a value that repeats a lot, like a spec or gender, as the code of its category."""
+    def __init__(self, size: int = INITIAL_COLUMN_SIZE) -> None:
+        super().__init__(np.int16, size)
+        self.categories = []
+        self.codes = {}
+
+    def append(self, value) -> None:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.categories)
+            self.codes[value] = code
+            self.categories.append(value)
+
+        super().append(code)
+
+    def to_array(self) -> np.ndarray:
+        return decode_categories(self.get_values(), self.categories)
+
+
+class TimeColumn(Column):
+    """Stores moments as simulated seconds since the start, they are only formatted to dates when exported."""
+    def __init__(self, formatter: Callable[[int], str], size: int = INITIAL_COLUMN_SIZE) -> None:
+        super().__init__(np.int64, size)
+        self.formatter = formatter
+
+    def to_array(self) -> np.ndarray:
+        return format_times(self.get_values(), self.formatter)
+
+
+class ColumnarDataCollector(DataCollector):
+    """
+        DataCollector that keeps its tables and model reporters in typed numpy columns instead of lists of Python objects.
+        Tables are given as a dict of column names to types: "time", "category" or a numpy dtype. A list of column names
+        gives object columns like the Mesa DataCollector. get_table_dataframe and get_model_vars_dataframe return the same
+        DataFrames as before, get_table_columns gives the raw columns without formatting.
+    """
+    def __init__(self, model_reporters: dict = None, tables: dict = None, time_formatter: Callable[[int], str] = str) -> None:
+        self.time_formatter = time_formatter
+        super().__init__(model_reporters=model_reporters, tables=tables)
+
+    def create_column(self, kind) -> Column:
+        if kind == "time":
+            return TimeColumn(self.time_formatter)
+        if kind == "category":
+            return CategoryColumn()
+        return Column(kind)
+
+    def _new_table(self, table_name: str, table_columns) -> None:
+        if not isinstance(table_columns, dict):
+            table_columns = { column: object for column in table_columns }
+
+        self.tables[table_name] = { column: self.create_column(kind) for column, kind in table_columns.items() }
+
+    def _new_model_reporter(self, name: str, reporter) -> None:
+        super()._new_model_reporter(name, reporter)
+        # The type of a reporter is only known once it reports, see collect
+        self.model_vars[name] = None
+
+    def add_table_row(self, table_name: str, row: dict, ignore_missing: bool = False) -> None:
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+
+        for column, values in self.tables[table_name].items():
+            if column in row:
+                values.append(row[column])
+            elif ignore_missing and values.values.dtype.kind in "fO":
+                values.append(np.nan if values.values.dtype.kind == "f" else None)
+            else:
+                raise Exception("Could not insert row with missing column")
+
+    def get_reporter_value(self, model, reporter):
+        if isinstance(reporter, types.LambdaType | partial):
+            return reporter(model)
+        if isinstance(reporter, str):
+            return getattr(model, reporter, None)
+        if isinstance(reporter, list):
+            return reporter[0](*reporter[1])
+        return reporter()
+
+    def collect(self, model) -> None:
+        for name, reporter in self.model_reporters.items():
+            value = self.get_reporter_value(model, reporter)
+            if self.model_vars[name] is None:
+                self.model_vars[name] = Column(np.asarray(value).dtype if np.isscalar(value) else object)
+            self.model_vars[name].append(value)
+
+        if self.agent_reporters:
+            self._agent_records[model.steps] = list(self._record_agents(model))
+
+        if self.agenttype_reporters:
+            self._agenttype_records[model.steps] = {
+                agent_type: list(self._record_agenttype(model, agent_type)) for agent_type in self.agenttype_reporters
+            }
+
+    def get_table_columns(self, table_name: str) -> dict[str, np.ndarray]:
+        """The columns of a table as stored: seconds for moments and codes for categories."""
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+
+        return { column: values.get_values() for column, values in self.tables[table_name].items() }
+
+    def get_table_dataframe(self, table_name: str) -> pd.DataFrame:
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+
+        return pd.DataFrame({ column: values.to_array() for column, values in self.tables[table_name].items() })
+
+    def get_model_vars_dataframe(self) -> pd.DataFrame:
+        if not self.model_reporters:
+            raise UserWarning("No model reporters have been defined in the DataCollector, returning empty DataFrame.")
+
+        return pd.DataFrame({ name: values.to_array() if values is not None else [] for name, values in self.model_vars.items() })
@@ -0,0 +1,243 @@
+import heapq
+import numpy as np
+from itertools import count
+from lib.agents import Home, Department
+from lib.agents.patient import WAITING, AT_DEPARTMENT, ADMITTED
+
+# Event kinds, events at the same time are handled in this order which follows the order agents are stepped in:
+# the front desk, the departments, home (starting the day before releasing arrivals) and the patients
+FRONTDESK_SERVICE = 0
+DISCHARGE = 1
+DAY_START = 2
+ARRIVAL = 3
+FRONTDESK_ARRIVAL = 4
+ADMISSION = 5
+SNAPSHOT = 6
+
+# Names of the event kinds in the profile of a model
+EVENT_NAMES = {
+    DAY_START: "day start",
+    FRONTDESK_SERVICE: "frontdesk service",
+    ARRIVAL: "arrival",
+    FRONTDESK_ARRIVAL: "frontdesk arrival",
+    ADMISSION: "admission",
+    DISCHARGE: "discharge",
+    SNAPSHOT: "snapshot"
+}
+
+
+class EventQueue:
+    """Priority queue of (time, kind) ordered events, ties are resolved in insertion order."""
+    def __init__(self) -> None:
+        self.heap = []
+        self.counter = count()
+
+    def push(self, time: int, kind: int, payload = None) -> None:
+        heapq.heappush(self.heap, (time, kind, next(self.counter), payload))
+
+    def pop(self) -> tuple:
+        time, kind, _, payload = heapq.heappop(self.heap)
+        return time, kind, payload
+
+    def peek_time(self) -> int:
+        return self.heap[0][0]
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+class EventEngine:
+    """
+        Runs the ICUModel as a discrete event simulation. Instead of stepping every agent each clock tick,
+        the clock jumps from event to event and only the agents involved in an event are touched.
+
+        Arrivals are released on the first clock step at or after their timestamp and new patients start moving a step later.
+        Walking to the front desk and on to a department takes one clock step each and the front desk helps service_rate
+        patients per step, just like in the stepped model, so both modes produce the same tables.
+        The stepped model charges every step for the empty beds after the agents stepped, so every moment with events is
+        charged after its events and the steps in between at the empty beds of the last moment before them.
+        The stepped model only sees a new hour or day on the first step on or after it, so those events are put on that step too.
+    """
+    def __init__(self, model) -> None:
+        self.model = model
+        self.queue = EventQueue()
+        self.now = 0
+        # The costs are charged up to and including this moment
+        self.charged = 0
+        self.service_pending = False
+
+        self.handlers = {
+            DAY_START: self.handle_day_start,
+            DISCHARGE: self.handle_discharge,
+            ARRIVAL: self.handle_arrival,
+            FRONTDESK_ARRIVAL: self.handle_frontdesk_arrival,
+            FRONTDESK_SERVICE: self.handle_frontdesk_service,
+            ADMISSION: self.handle_admission,
+            SNAPSHOT: self.handle_snapshot
+        }
+
+        # The first day starts on the first step, like the stepped model
+        self.queue.push(self.step_size, DAY_START)
+        self.queue.push(self.align(3600), SNAPSHOT)
+
+    @property
+    def step_size(self) -> int:
+        return self.model.clock.clock_speed
+
+    def align(self, time: int) -> int:
+        """The first clock step on or after the given moment."""
+        return -(-time // self.step_size) * self.step_size
+
+    def get_next_snapshot(self) -> int:
+        return self.align((self.now // 3600 + 1) * 3600)
+
+    def run_until(self, time: int) -> None:
+        """Handles all events up to and including the given amount of simulated seconds."""
+        profiler = self.model.profiler
+        while len(self.queue) > 0 and self.queue.peek_time() <= time:
+            event_time, kind, payload = self.queue.pop()
+            self.advance_to(event_time)
+            if profiler is None:
+                self.handlers[kind](payload)
+            else:
+                with profiler.measure("event", EVENT_NAMES[kind]):
+                    self.handlers[kind](payload)
+
+        self.advance_to(time)
+        self.charge_costs()
+
+    def advance_to(self, time: int) -> None:
+        if time <= self.now:
+            return
+
+        if self.model.profiler is not None:
+            with self.model.profiler.measure("phase", "clock and costs"):
+                self.advance_clock(time)
+        else:
+            self.advance_clock(time)
+
+    def charge_costs(self) -> None:
+        """Charges the steps up to now, once all events of this moment are handled."""
+        if self.charged < self.now:
+            self.model.accrue_costs(self.now - self.charged)
+            self.charged = self.now
+
+    def advance_clock(self, time: int) -> None:
+        # The amount of empty beds only changes on events, so the steps up to the one before time are charged at once.
+        # The step at time is charged after its events
+        self.charge_costs()
+        if self.charged < time - self.step_size:
+            self.model.accrue_costs(time - self.step_size - self.charged)
+            self.charged = time - self.step_size
+        self.model.clock.advance(time - self.now)
+        self.now = time
+        self.model.start_year()
+
+    def on_rescheduled(self, day: int) -> None:
+        # Days that already started were expanded into events, so a patient moved to today has to be added by hand.
+        # The stepped model steps Home after the front desk, which releases the patient in the same step. A day that
+        # starts in this moment still has its day start to come, which picks the patient up
+        if day == self.model.agents_by_type[Home][0].current_day:
+            self.queue.push(self.now, ARRIVAL)
+
+    def resume(self) -> None:
+        """
+            Fills the queue of a model restored from a snapshot with the events that follow from its state,
+            the same events the engine would have had pending at that moment.
+        """
+        model = self.model
+        clock = model.clock
+        home = model.agents_by_type[Home][0]
+        self.queue = EventQueue()
+        self.now = clock.elapsed
+        # A snapshot is taken at the end of a moment, which has been charged
+        self.charged = self.now
+        step = self.step_size
+
+        day_start = self.now - clock.get_day_timestamp()
+        if home.current_day != clock.day_index:
+            # Only a model that hasn't taken its first step yet, its day starts on that step
+            self.queue.push(self.now + step, DAY_START)
+        else:
+            self.queue.push(self.align(day_start + clock.seconds_in_day), DAY_START)
+            # The arrivals of today that are still to come, arrivals that are already due come on the next step
+            timestamps = np.concatenate((model.unplanned_schedules[home.current_day], model.agent_schedules[home.current_day]))
+            for arrival_time in np.unique(np.maximum(self.align(day_start + timestamps), self.now + step)):
+                if arrival_time < day_start + clock.seconds_in_day:
+                    self.queue.push(int(arrival_time), ARRIVAL)
+        self.queue.push(self.get_next_snapshot(), SNAPSHOT)
+
+        discharge_times = set()
+        for patient in model.get_patients():
+            if patient.state == WAITING:
+                self.queue.push(self.now + step, FRONTDESK_ARRIVAL, patient)
+            elif patient.state == AT_DEPARTMENT:
+                self.queue.push(self.now + step, ADMISSION, patient)
+            elif patient.state == ADMITTED:
+                discharge_times.add(patient.discharge_at)
+        for discharge_time in sorted(discharge_times):
+            self.queue.push(discharge_time, DISCHARGE)
+
+        self.service_pending = len(model.get_front_desk().queue) > 0
+        if self.service_pending:
+            self.queue.push(self.now + step, FRONTDESK_SERVICE)
+
+    def handle_day_start(self, _) -> None:
+        home = self.model.agents_by_type[Home][0]
+        home.start_day()
+
+        # One release per clock step that has arrivals, timestamps are rounded up to the next clock step. The day started
+        # on the first step on or after midnight, which doesn't have to be midnight itself
+        day = home.current_day
+        day_start = self.now - self.model.clock.get_day_timestamp()
+        day_end = day_start + self.model.clock.seconds_in_day
+        timestamps = np.concatenate((self.model.unplanned_schedules[day], self.model.agent_schedules[day]))
+        for arrival_time in np.unique(self.align(day_start + timestamps)):
+            # Timestamps after the last step of the day are never reached by the stepped model either
+            if arrival_time < day_end:
+                # The first day starts on the first step, arrivals before it come with it
+                self.queue.push(max(int(arrival_time), self.now), ARRIVAL)
+
+        self.queue.push(self.align(day_end), DAY_START)
+
+    def handle_arrival(self, _) -> None:
+        for patient in self.model.agents_by_type[Home][0].release_arrivals():
+            self.queue.push(self.now + self.step_size, FRONTDESK_ARRIVAL, patient)
+
+    def handle_frontdesk_arrival(self, patient) -> None:
+        patient.go_to_front_desk()
+
+        # The front desk only sees patients that were already waiting when it took its step
+        if not self.service_pending:
+            self.service_pending = True
+            self.queue.push(self.now + self.step_size, FRONTDESK_SERVICE)
+
+    def handle_frontdesk_service(self, _) -> None:
+        frontdesk = self.model.get_front_desk()
+        for patient in frontdesk.serve():
+            self.queue.push(self.now + self.step_size, ADMISSION, patient)
+
+        self.service_pending = len(frontdesk.queue) > 0
+        if self.service_pending:
+            self.queue.push(self.now + self.step_size, FRONTDESK_SERVICE)
+
+    def handle_admission(self, patient) -> None:
+        patient.go_to_department()
+        patient.admit()
+        if patient.discharge_at <= self.now:
+            patient.discharge()
+        else:
+            self.queue.push(patient.discharge_at, DISCHARGE)
+
+    def handle_discharge(self, _) -> None:
+        # The departments hold the admitted patients by their discharge moment, a discharge event lets every department
+        # discharge what is due, so patients leaving at the same moment go in the same order as in the stepped model
+        for department in self.model.agents_by_type[Department]:
+            department.discharge_due_patients()
+
+    def handle_snapshot(self, _) -> None:
+        # The last event of its moment, so the moment can be charged before the costs are recorded
+        self.charge_costs()
+        self.model.datacollector.collect(self.model)
+        self.model.record_costs_and_capacity()
+        self.queue.push(self.get_next_snapshot(), SNAPSHOT)
@@ -1,13 +1,25 @@
 from mesa import Model
-from mesa.datacollection import DataCollector
 from mesa.space import MultiGrid
 from lib.agents import Patient, Frontdesk, Department, Home
 
-from lib.utils import Clock, DataManager
-from typing import List
+from lib.utils import Clock, DataManager, ICU_SPIKE_SCALE
+from lib.engine import EventEngine
+from lib.datacollection import ColumnarDataCollector
+from lib.schedule import ArrivalSchedule
+from lib.profiling import Profiler
+from lib.streams import create_streams
+from lib.snapshot import create_snapshot, restore_snapshot
+from lib.patient_store import PatientStore
 import numpy as np
+import pandas as pd
 import solara
+import warnings
 
+# Amount of patients drawn from the DataManager at once
+PATIENT_BUFFER_SIZE = 256
+# The streams of the attributes and the length of stay of every buffer of patients, the IC spike patients have their own
+# so turning the spike on doesn't change the regular patients
+PATIENT_STREAMS = { "patients": ("patients", "los"), "spike_patients": ("spike_patients", "spike_los") }
 
 
 class ICUModel(Model):
@@ -19,11 +31,22 @@ class ICUModel(Model):
                  capacity: int = 32,
                  efficiency: int = 0,
                  pandemic_allocation_percentage: int = 0,
-                 use_ic_spike: bool = False) -> None:
+                 use_ic_spike: bool = False,
+                 ic_spike_scale: float = ICU_SPIKE_SCALE,
+                 event_driven: bool = False,
+                 service_rate: int = 1,
+                 queue_discipline: str = "fifo",
+                 headless: bool = False,
+                 reschedule_same_patient: bool = True,
+                 profile: bool = False,
+                 patient_store: bool = False) -> None:
         super().__init__(seed=seed)
 
-        if (seed is not None):
-            np.random.seed(seed=seed)
+        # Named random streams derived from the seed, see lib/streams.py
+        self.streams = create_streams(seed)
+
+        # Times every phase of a step and every agent type, see get_profile_dataframe
+        self.profiler = Profiler() if profile else None
 
         self.departments = departments
         if (len(self.departments.value) != len(distribution.value)):
@@ -38,23 +61,29 @@ class ICUModel(Model):
         self.pandemic_allocation_percentage = pandemic_allocation_percentage / 100 if pandemic_allocation_percentage != 0 else 0
         self.capacity = capacity
         self.use_ic_spike = use_ic_spike
+        # Share of the national covid IC admissions that come to this IC, see lib/utils.py
+        self.ic_spike_scale = ic_spike_scale
+        # Replanned patients come back with their own spec, age, gender and length of stay instead of a newly drawn patient
+        self.reschedule_same_patient = reschedule_same_patient
+
+        # The arguments of the model as plain values, a snapshot keeps them to create the model again
+        self.parameters = {
+            "seed": seed, "size": size, "amount": amount, "clock_speed": clock_speed,
+            "departments": [list(x) for x in self.departments.value], "distribution": list(self.distribution.value), "is_specialized": list(self.is_specialized.value),
+            "planning_method": planning_method, "capacity": capacity, "efficiency": efficiency, "pandemic_allocation_percentage": pandemic_allocation_percentage,
+            "use_ic_spike": use_ic_spike, "ic_spike_scale": ic_spike_scale, "event_driven": event_driven, "service_rate": service_rate, "queue_discipline": queue_discipline,
+            "headless": headless, "reschedule_same_patient": reschedule_same_patient, "patient_store": patient_store
+        }
         
         
-        self.space = MultiGrid(size, size, torus=False)
+        # The grid is only used to draw the model, headless runs skip it and patients only keep their state
+        self.size = size
+        self.space = None if headless else MultiGrid(size, size, torus=False)
         self.clock = Clock(clock_speed)
         self.datamanager = DataManager()
-        self.datacollector = DataCollector(model_reporters={
-            "Capacity": lambda m: sum([x.current_capacity for x in m.agents_by_type[Department]])
-            # "Costs": lambda m: sum([x.capacity * 2500 / m.clock.seconds_in_day * m.clock.clock_speed for x in m.agents_by_type[Department]])
-        },
-        tables={
-            "admissions": ["ref_spec", "adm_icu", "dis_icu", "los_icu", "age", "gender", "plan_adm"],
-            "refused": ["date", "ref_spec"],
-            "costs": ["date", "amount_empty_beds", "cumulative_hourly_costs", "cumulative_daily_costs"],
-            "capacity": ["date"] + [", ".join(x) for x in self.departments.value],
-            "amount": ["date", "admissions"],
-            "replanning": ["date", "planning_method"]
-        })
+        self.datacollector = self.create_datacollector()
+        # Rows of every table before the snapshot a model was restored from
+        self.table_offsets = {}
 
         self.amount = amount
         self.current_year = self.clock.year
@@ -64,99 +93,199 @@ class ICUModel(Model):
         self.cumulative_hourly_costs = 0
         self.cumulative_daily_costs = 0
 
+        self.patient_buffers = { name: {} for name in PATIENT_STREAMS }
+        self.patient_buffer_indices = { name: PATIENT_BUFFER_SIZE for name in PATIENT_STREAMS }
+        # Patients that aren't admitted yet in the order they were created, used as an ordered set
+        self.patients_in_transit = {}
+        # Headless runs can keep the patients in NumPy columns instead of agents, see lib/patient_store.py
+        if patient_store and not headless:
+            raise ValueError("The patient store only works in headless runs, its patients have no place on the grid")
+        self.patient_store = PatientStore(self) if patient_store else None
+
+        # Patients replanned past the end of the year, they are added to the schedules of the next year once it starts
+        self.next_agent_schedules = ArrivalSchedule(366)
         self.create_agent_schedules()
-        self.create_front_desk(planning_method)
+        self.create_front_desk(planning_method, service_rate, queue_discipline)
         self.create_departments()
         self.create_home()
         
         self.datacollector.collect(self)
 
-    def get_normally_distributed_timestamps(self, size: int = 1, planned: bool = False) -> List[int]:
+        # In event driven mode the agents are not stepped, the engine only handles the moments something happens
+        self.event_driven = event_driven
+        self.engine = EventEngine(self) if event_driven else None
+
+    def create_datacollector(self) -> ColumnarDataCollector:
+        return ColumnarDataCollector(model_reporters={
+            "Capacity": lambda m: sum([x.current_capacity for x in m.agents_by_type[Department]]),
+            "Queue length": lambda m: len(m.get_front_desk().queue)
+            # "Costs": lambda m: sum([x.capacity * 2500 / m.clock.seconds_in_day * m.clock.clock_speed for x in m.agents_by_type[Department]])
+        },
+        # Moments are stored as elapsed seconds and formatted by the clock when a table is exported
+        tables={
+            "admissions": { "ref_spec": "category", "adm_icu": "time", "dis_icu": "time", "los_icu": np.float64, "age": np.int64, "gender": "category", "plan_adm": bool },
+            "refused": { "date": "time", "ref_spec": "category" },
+            "costs": { "date": "time", "amount_empty_beds": np.int64, "cumulative_hourly_costs": np.float64, "cumulative_daily_costs": np.float64 },
+            "capacity": { "date": "time", **{ ", ".join(x): np.int64 for x in self.departments.value } },
+            "amount": { "date": "time", "admissions": np.int64 },
+            "replanning": { "date": "time", "planning_method": np.int64 },
+            "waiting": { "date": "time", "ref_spec": "category", "plan_adm": bool, "wait_time": np.int64 }
+        },
+        time_formatter=self.clock.format_time)
+
+    def get_normally_distributed_timestamps(self, size: int = 1, planned: bool = False, stream: str = "arrivals") -> np.ndarray:
         mean, std_dev = self.datamanager.get_mean_std_by_planned(planned)
         min_value = 0
         max_value = 24 * 3600  # 24 hours in seconds
 
         # Generate a normal random value
-        timestamps = np.random.normal(mean, std_dev, size=size)
+        timestamps = self.streams[stream].normal(mean, std_dev, size=size)
 
         # Clamp the value between min and max
-        return [max(min(int(timestamp), max_value), min_value) for timestamp in timestamps]
+        return np.clip(timestamps.astype(int), min_value, max_value)
 
     """
-        This function will create all planned agents using the existing self.create_agent function
-        It will loop through an entire year (each day) and determine the agents that have to spawn on that day
+        This function will create the arrival schedules of the year that just started, for planned and unplanned patients
+        The amount of patients of every day is determined first, after which the timestamps of all of them are drawn at once
 
-        This function is used in the init to create a schedule for when an agent should spawn
+        This function is used in the init and at the start of every year, the Home agent releases the arrivals
+        Patients that were replanned into the new year are added to its planned arrivals
 
     """
     def create_agent_schedules(self) -> None:
-        self.agent_schedules = {}
-        amount = 0
-        for i in range(365):
-            percentage = self.datamanager.get_amount_percentage_by_day(i + 1, True)
-            
-            amount_of_agents_today = int(self.amount * percentage)
-            amount += percentage
-            schedule = np.sort(self.get_normally_distributed_timestamps(amount_of_agents_today, True))
-            self.agent_schedules[(i+1)] = schedule
+        days = self.clock.days_in_year
+        planned_counts = (self.amount * self.datamanager.get_amount_percentages(True)[:days]).astype(int)
+        unplanned_counts = (self.amount * self.datamanager.get_amount_percentages(False)[:days]).astype(int)
 
-        
-        
-    def create_agent(self, planned: bool = False) -> None:
-        data = self.datamanager.create_patients(1)[0]
+        # The IC spike arrivals are pandemic patients, which can use the beds reserved for them
+        spike_counts = np.zeros(days, dtype=int)
+        if(self.use_ic_spike):
+            spike_counts = self.datamanager.get_icu_spike_counts(self.clock.days + 1, days, self.ic_spike_scale)
+
+        self.agent_schedules = ArrivalSchedule.from_counts(planned_counts, self.get_normally_distributed_timestamps(planned_counts.sum(), True))
+        self.agent_schedules.insert_from(self.next_agent_schedules)
+        self.next_agent_schedules = ArrivalSchedule(366)
+
+        counts = unplanned_counts + spike_counts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pandemic = positions >= np.repeat(unplanned_counts, counts)
+
+        # The spike arrivals are drawn from their own stream, so turning the spike on doesn't move the regular arrivals
+        timestamps = np.zeros(counts.sum(), dtype=int)
+        timestamps[~pandemic] = self.get_normally_distributed_timestamps(unplanned_counts.sum(), False)
+        timestamps[pandemic] = self.get_normally_distributed_timestamps(spike_counts.sum(), False, "spike_arrivals")
+        self.unplanned_schedules = ArrivalSchedule.from_counts(counts, timestamps, pandemic)
+
+    
+    def next_patient_data(self, pandemic: bool = False) -> dict:
+        """Pops the next pre-drawn patient, drawing a new block of patients once the buffer runs empty. IC spike patients come from their own buffer."""
+        name = "spike_patients" if pandemic else "patients"
+        if self.patient_buffer_indices[name] >= PATIENT_BUFFER_SIZE:
+            patients, los = PATIENT_STREAMS[name]
+            self.patient_buffers[name] = self.datamanager.patient_sampler.sample(PATIENT_BUFFER_SIZE, self.streams[patients], self.streams[los])
+            self.patient_buffer_indices[name] = 0
+
+        index = self.patient_buffer_indices[name]
+        self.patient_buffer_indices[name] += 1
+        return { key: values[index] for key, values in self.patient_buffers[name].items() }
+
+    def create_agent(self, planned: bool = False, pandemic: bool = False, data: dict = None) -> Patient:
+        if data is None:
+            data = self.next_patient_data(pandemic)
+        if self.patient_store is not None:
+            return self.patient_store.add(planned, pandemic, data)
         # x = self.random.randint(0, self.space.width - 1)
         # y = self.random.randint(0, self.space.height - 1)
         
-        agent = Patient(self, age=data["age"],  gender=data["gender"], planned=planned, spec=data["ref_spec"], los_icu=data["los_icu"])
-        pos = self.agents_by_type[Home][0].pos
-        self.space.place_agent(agent, pos)    
+        agent = Patient(self, age=data["age"],  gender=data["gender"], planned=planned, spec=data["ref_spec"], los_icu=data["los_icu"], bed_type="pandemic" if pandemic else "normal")
+        if self.space is not None:
+            self.space.place_agent(agent, self.agents_by_type[Home][0].pos)
+        return agent
+
+    def get_patients(self) -> list:
+        """All patients in the order they were created, the agents or the handles of the patient store."""
+        if self.patient_store is not None:
+            return self.patient_store.get_patients()
+        return list(self.agents_by_type[Patient]) if Patient in self.agents_by_type else []
+
+    def place_agent(self, agent, pos: tuple[int, int]) -> None:
+        if self.space is not None:
+            self.space.place_agent(agent, pos)
+        else:
+            agent.pos = pos
         
-    def create_front_desk(self, planning_method: int) -> None: 
-        pos = (int(self.space.width / 2), int(self.space.height / 4))
-        agent = Frontdesk(self, pos=pos, planning_method=planning_method)
-        self.space.place_agent(agent, pos)
+    def create_front_desk(self, planning_method: int, service_rate: int, queue_discipline: str) -> None: 
+        pos = (int(self.size / 2), int(self.size / 4))
+        agent = Frontdesk(self, pos=pos, planning_method=planning_method, service_rate=service_rate, queue_discipline=queue_discipline)
+        self.place_agent(agent, pos)
 
     def create_departments(self) -> None: 
         for i in range(len(self.departments.value)):
             index = i + 1
-            pos = (int(self.space.width / (len(self.departments.value) + 1)) * index, int(self.space.height - self.space.height / 4))
+            pos = (int(self.size / (len(self.departments.value) + 1)) * index, int(self.size - self.size / 4))
             
             agent = Department(self, specs=self.departments.value[i], capacity=int(self.capacity * self.distribution.value[i]), is_specialized=self.is_specialized.value[i])
-            self.space.place_agent(agent, pos)
+            self.place_agent(agent, pos)
+
+        self.build_department_index()
+
+    def build_department_index(self) -> None:
+        """
+            Maps every spec to the department that treats it, so routing a patient is a single lookup.
+            Specs that no department or several departments treat are reported in self.routing_report and warned about,
+            when several departments treat a spec the last one gets the patients.
+            The index follows the specs of the departments, changes to the departments reactive apply to the next model.
+        """
+        assignments = { spec: [] for spec in self.datamanager.OPTIONS.keys() }
+        self.department_index = {}
+
+        for department in self.agents_by_type[Department]:
+            for spec in department.specs:
+                self.department_index[spec] = department
+                assignments.setdefault(spec, []).append(", ".join(department.specs))
+
+        self.routing_report = {
+            "unmapped": [spec for spec, groups in assignments.items() if len(groups) == 0],
+            "duplicated": { spec: groups for spec, groups in assignments.items() if len(groups) > 1 }
+        }
+
+        if len(self.routing_report["unmapped"]) > 0:
+            warnings.warn(f"No department treats {', '.join(self.routing_report['unmapped'])}, these patients will be refused or replanned")
+        for spec, groups in self.routing_report["duplicated"].items():
+            warnings.warn(f"{spec} is treated by the departments {groups}, only [{groups[-1]}] will get these patients")
 
     def create_home(self) -> None:
         agent = Home(self, self.create_agent)
-        self.space.place_agent(agent, (0, 0))
+        self.place_agent(agent, (0, 0))
+
+    def get_front_desk(self) -> Frontdesk:
+        return self.agents_by_type[Frontdesk][0]
 
     def get_front_desk_location(self) -> tuple[int, int]:
-        return self.agents_by_type[Frontdesk][0].row_pos
+        return self.get_front_desk().row_pos
     
     def get_icu_department(self, spec: str) -> Department:
-        result = None
-        for department in self.agents_by_type[Department]:
-            if spec in department.specs:
-                result = department
-        return result
+        return self.department_index.get(spec)
 
-    def capture_costs_and_capacity_data(self) -> None:
-        # IC costs 2500 euros per day so we divide it by the amount of seconds in a day and multiply it by clock_speed to get costs per second per bed
-
-        cost_per_bed_per_step = 2500 / (60 * 60 * 24) * self.clock.clock_speed        
-        cost_per_step = sum([cost_per_bed_per_step * department.current_capacity for department in self.agents_by_type[Department]])
+    def accrue_costs(self, seconds: int) -> None:
+        # IC costs 2500 euros per day so we divide it by the amount of seconds in a day and multiply it by the elapsed seconds to get costs per bed
+        cost_per_bed = 2500 / (60 * 60 * 24) * seconds
+        costs = sum([cost_per_bed * department.current_capacity for department in self.agents_by_type[Department]])
 
-        self.cumulative_daily_costs += cost_per_step
-        self.cumulative_hourly_costs += cost_per_step
+        self.cumulative_daily_costs += costs
+        self.cumulative_hourly_costs += costs
 
+    def record_costs_and_capacity(self) -> None:
         if(self.current_hour != self.clock.hour):
             self.datacollector.add_table_row("costs", {
-                "date": self.clock.get_time(True),
+                "date": self.clock.elapsed,
                 "amount_empty_beds":  sum([department.current_capacity for department in self.agents_by_type[Department]]),
                 "cumulative_hourly_costs": self.cumulative_hourly_costs,
                 "cumulative_daily_costs": self.cumulative_daily_costs
             })
 
             capacity_data = {
-                "date": self.clock.get_time(True)
+                "date": self.clock.elapsed
             }
 
             for department in self.agents_by_type[Department]:
@@ -171,22 +300,111 @@ class ICUModel(Model):
         if(self.current_day != self.clock.day):
             self.current_day = self.clock.day
             self.cumulative_daily_costs = 0
-        
-        pass
-
-    def step(self) -> None:
-        self.clock.step()
-        self.agents.do("step")
-        self.datacollector.collect(self)
-        
-
-        self.capture_costs_and_capacity_data()
 
+    def start_year(self) -> None:
+        """
+            Switches to the schedules of a year that just began. This happens before anything else in the first moment of
+            the year, so a patient replanned in that moment goes into the new schedules, in both modes.
+        """
         if(self.current_year != self.clock.year):
             self.current_year = self.clock.year
             self.create_agent_schedules()
+
+    def capture_costs_and_capacity_data(self) -> None:
+        self.accrue_costs(self.clock.clock_speed)
+        self.record_costs_and_capacity()
+
+    def run_for_days(self, days: int) -> None:
+        """Simulates the given amount of days, the event driven engine jumps straight to the end instead of stepping."""
+        steps = int((60 * 24 * days) / (self.clock.clock_speed / 60))
+        if self.engine is not None:
+            self.engine.run_until(self.engine.now + steps * self.clock.clock_speed)
+            # The steps the engine jumped over count as taken, like the steps of a stepped run
+            self.steps += steps
+            return
+
+        for _ in range(steps):
+            self.step()
+
+    def step(self) -> None:
+        if self.engine is not None:
+            self.engine.run_until(self.engine.now + self.clock.clock_speed)
+            return super().step()
+
+        if self.profiler is not None:
+            self.profiled_step()
+        else:
+            self.clock.step()
+            self.start_year()
+            self.step_agents()
+            self.datacollector.collect(self)
+            self.capture_costs_and_capacity_data()
         
         if(self.clock.day == 25 and self.clock.hour == 23 and self.clock.minute == 50):
             print(self.clock.get_time())
         return super().step()
-    
+
+    def step_agents(self, step_agent = None) -> None:
+        """
+            Steps the agents in the order of agents.do("step"), except for the admitted patients: nothing happens to them
+            until their department discharges them. Patients that arrive during the step are stepped from the next step on.
+        """
+        patients = list(self.patients_in_transit)
+        next_id = self.patient_store.next_id if self.patient_store is not None else None
+        for agent_type, agents in list(self.agents_by_type.items()):
+            if agent_type is not Patient:
+                agents.do(step_agent or "step")
+
+        if self.patient_store is not None:
+            self.patient_store.step(next_id)
+
+        for patient in patients:
+            # Patients the front desk sent away in this step are gone
+            if patient in self.patients_in_transit:
+                if step_agent is None:
+                    patient.step()
+                else:
+                    step_agent(patient)
+
+    def profiled_step(self) -> None:
+        """The phases of a step, each timed by the profiler. Agents are stepped in the same order as step_agents."""
+        with self.profiler.measure("phase", "clock"):
+            self.clock.step()
+            self.start_year()
+        with self.profiler.measure("phase", "agents"):
+            self.step_agents(self.profiler.step_agent)
+        with self.profiler.measure("phase", "collect"):
+            self.datacollector.collect(self)
+        with self.profiler.measure("phase", "costs and capacity"):
+            self.capture_costs_and_capacity_data()
+
+    def get_profile_dataframe(self) -> pd.DataFrame:
+        """
+            Cumulative time and calls of every phase of a step and every agent type, or of every event kind in event driven mode.
+            Only available when the model was created with profile=True.
+        """
+        if self.profiler is None:
+            raise ValueError("The model isn't profiled, create it with profile=True")
+
+        return self.profiler.get_dataframe()
+
+    def create_snapshot(self) -> dict:
+        """The full state of the model, see lib/snapshot.py. Save it with save_snapshot to branch runs from it later."""
+        return create_snapshot(self)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict, **parameters) -> "ICUModel":
+        """
+            Creates a model in the state of the snapshot. Parameters given here replace the ones the snapshot was taken with,
+            like planning_method, efficiency or capacity, the department groups have to stay the same. A seed draws new
+            random numbers from the snapshot on, without one the random streams continue where the snapshot left them.
+        """
+        arguments = { **snapshot["header"]["parameters"], **parameters }
+        for key in ["departments", "distribution", "is_specialized"]:
+            if not isinstance(arguments[key], solara.Reactive):
+                arguments[key] = solara.reactive(arguments[key])
+
+        model = cls(**arguments)
+        restore_snapshot(model, snapshot, reseed="seed" in parameters)
+        return model
+
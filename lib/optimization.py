@@ -0,0 +1,204 @@
+from lib.replication import RunningStatistics
+from typing import Callable
+import numpy as np
+import pandas as pd
+
+# The objectives of a candidate, both are minimized
+OBJECTIVES = ["refusal_rate", "cumulative_costs"]
+
+
+def beds_to_distribution(beds: list[int]) -> list[float]:
+    """
+        The distribution for which ICUModel gives every department group exactly its amount of beds. Departments get
+        int(capacity * share) beds, so a share that rounds just below its amount of beds is moved up to the next float.
+    """
+    capacity = sum(beds)
+    distribution = []
+    for amount in beds:
+        share = amount / capacity
+        while int(capacity * share) < amount:
+            share = float(np.nextafter(share, 1))
+        distribution.append(share)
+
+    return distribution
+
+def distribution_to_beds(capacity: int, distribution: list[float]) -> list[int]:
+    """Splits all beds over the groups by the distribution, the beds lost to rounding go to the largest remainders."""
+    shares = capacity * np.asarray(distribution) / np.sum(distribution)
+    beds = np.floor(shares).astype(int)
+    for index in np.argsort(beds - shares)[:capacity - beds.sum()]:
+        beds[index] += 1
+
+    return [int(x) for x in beds]
+
+
+class Candidate:
+    """A total amount of beds and its split over the department groups, with the statistics of its replications."""
+    def __init__(self, capacity: int, distribution: list[float]) -> None:
+        self.capacity = capacity
+        self.distribution = distribution
+        self.statistics = { objective: RunningStatistics() for objective in OBJECTIVES }
+        self.stopped = False
+
+    @property
+    def replications(self) -> int:
+        return self.statistics[OBJECTIVES[0]].count
+
+    def add(self, kpis: dict[str, float]) -> None:
+        for objective in OBJECTIVES:
+            self.statistics[objective].add(kpis[objective])
+
+    def mean(self, objective: str = "refusal_rate") -> float:
+        return self.statistics[objective].mean
+
+    def interval(self, confidence: float, objective: str = "refusal_rate") -> tuple[float, float]:
+        """Confidence interval of the mean, unbounded while there are too few replications to estimate it."""
+        half_width = self.statistics[objective].get_half_width(confidence)
+        if np.isnan(half_width):
+            return -np.inf, np.inf
+
+        return self.mean(objective) - half_width, self.mean(objective) + half_width
+
+
+class CapacityOptimizer:
+    """
+        Searches the smallest capacity and best split of the beds over the department groups that keeps the refusal rate
+        below a target. The total amount of beds is found by bisection, after which the split is improved by moving beds
+        between groups (coordinate search) at one bed less than that, where the split makes a difference. The capacity is
+        then bisected again with the improved split, until it doesn't get any smaller.
+
+        Every candidate runs the same seeds, replication by replication. Candidates are raced: once a candidate has
+        min_replications, it stops as soon as its confidence interval shows it's clearly above or below the target, or
+        clearly worse than the best candidate it is compared with.
+        evaluate gets a list of (candidate, seed) pairs and returns the KPIs of each run, so runs can go in parallel.
+    """
+    def __init__(self, evaluate: Callable[[list[tuple[Candidate, int]]], list[dict[str, float]]], seeds: list[int], target: float,
+                 confidence: float = 0.95, min_replications: int = 3) -> None:
+        self.evaluate = evaluate
+        self.seeds = seeds
+        self.target = target
+        self.confidence = confidence
+        self.min_replications = max(min_replications, 2)
+        self.candidates: dict[tuple, Candidate] = {}
+
+    def get_candidate(self, capacity: int, beds: list[int] = None, distribution: list[float] = None) -> Candidate:
+        """Candidates are kept, so a split that is visited again reuses its replications."""
+        distribution = beds_to_distribution(beds) if beds is not None else distribution
+        key = (capacity, tuple(distribution))
+        if key not in self.candidates:
+            self.candidates[key] = Candidate(capacity, distribution)
+        candidate = self.candidates[key]
+        candidate.stopped = False
+        return candidate
+
+    def race(self, candidates: list[Candidate], stop: Callable[[list[Candidate]], None]) -> None:
+        """Adds replications to the candidates that are still running until stop stopped them or the seeds run out."""
+        for replication, seed in enumerate(self.seeds):
+            running = [x for x in candidates if not x.stopped and x.replications <= replication]
+            if len(running) > 0:
+                for candidate, kpis in zip(running, self.evaluate([(x, seed) for x in running])):
+                    candidate.add(kpis)
+
+            if replication + 1 >= self.min_replications:
+                stop(candidates)
+            if all([x.stopped for x in candidates]):
+                break
+
+    def is_feasible(self, candidate: Candidate) -> bool:
+        def stop(candidates: list[Candidate]) -> None:
+            low, high = candidates[0].interval(self.confidence)
+            candidates[0].stopped = high <= self.target or low > self.target
+
+        self.race([candidate], stop)
+        return candidate.mean() <= self.target
+
+    def bisect_capacity(self, low: int, high: int, distribution: list[float] = None, beds: list[int] = None) -> int:
+        """Smallest capacity in [low, high] that meets the target, high when even high doesn't."""
+        def get_candidate(capacity: int) -> Candidate:
+            if beds is not None:
+                return self.get_candidate(capacity, distribution_to_beds(capacity, beds))
+            return self.get_candidate(capacity, distribution=distribution)
+
+        while low < high:
+            middle = (low + high) // 2
+            if self.is_feasible(get_candidate(middle)):
+                high = middle
+            else:
+                low = middle + 1
+
+        return high
+
+    def search_split(self, capacity: int, beds: list[int], max_iterations: int = 20) -> list[int]:
+        """
+            Moves step beds from one group to another and keeps the move with the lowest refusal rate, halving step when
+            no move helps. Returns the best split found.
+        """
+        def stop(candidates: list[Candidate]) -> None:
+            best_high = min([x.interval(self.confidence)[1] for x in candidates])
+            for candidate in candidates:
+                candidate.stopped = candidate.interval(self.confidence)[0] > best_high
+
+        step = max(1, capacity // 8)
+        for _ in range(max_iterations):
+            neighbours = []
+            for i in range(len(beds)):
+                for j in range(len(beds)):
+                    if i != j and beds[j] - step >= 1:
+                        neighbour = list(beds)
+                        neighbour[i] += step
+                        neighbour[j] -= step
+                        neighbours.append(neighbour)
+
+            current = self.get_candidate(capacity, beds)
+            candidates = [current] + [self.get_candidate(capacity, x) for x in neighbours]
+            self.race(candidates, stop)
+
+            best = min(range(len(candidates)), key=lambda x: (candidates[x].mean(), candidates[x].mean("cumulative_costs")))
+            if best > 0 and candidates[best].mean() < current.mean():
+                beds = neighbours[best - 1]
+            elif step > 1:
+                step //= 2
+            else:
+                break
+
+        return beds
+
+    def optimize(self, low: int, high: int, distribution: list[float], max_iterations: int = 20) -> dict:
+        capacity = self.bisect_capacity(low, high, distribution=distribution)
+        beds = distribution_to_beds(capacity, distribution)
+        while len(beds) > 1 and capacity > low:
+            split = self.search_split(capacity - 1, distribution_to_beds(capacity - 1, beds), max_iterations)
+            smallest = self.bisect_capacity(low, capacity, beds=split)
+            if smallest >= capacity:
+                break
+            capacity, beds = smallest, split
+
+        beds = distribution_to_beds(capacity, beds)
+
+        best = self.get_candidate(capacity, beds)
+        return {
+            "capacity": capacity,
+            "beds": beds,
+            "distribution": best.distribution,
+            "feasible": bool(best.mean() <= self.target)
+        }
+
+    def get_candidates_dataframe(self) -> pd.DataFrame:
+        rows = []
+        for candidate in self.candidates.values():
+            if candidate.replications == 0:
+                continue
+            row = { "capacity": candidate.capacity, "distribution": candidate.distribution, "replications": candidate.replications }
+            for objective in OBJECTIVES:
+                row[objective] = candidate.mean(objective)
+                row[f"{objective}_half_width"] = candidate.statistics[objective].get_half_width(self.confidence)
+            rows.append(row)
+
+        return pd.DataFrame(rows, columns=["capacity", "distribution", "replications"] + [f"{x}{y}" for x in OBJECTIVES for y in ["", "_half_width"]])
+
+
+def get_pareto_front(dataframe: pd.DataFrame, objectives: list[str] = OBJECTIVES) -> pd.DataFrame:
+    """The rows no other row beats on every objective (all minimized), sorted by the first objective."""
+    values = dataframe[objectives].to_numpy()
+    dominated = np.array([np.any(np.all(values <= row, axis=1) & np.any(values < row, axis=1)) for row in values], dtype=bool)
+    return dataframe[~dominated].sort_values(objectives).reset_index(drop=True)
@@ -123,6 +123,25 @@ model_parameters = {
         "max": 50,
         "step": 1
     },
+    "service_rate": {
+        "type": "SliderInt",
+        "value": 1,
+        "label": "Patients helped by the front desk per step",
+        "min": 1,
+        "max": 10,
+        "step": 1
+    },
+    "queue_discipline": {
+        "type": "Select",
+        "value": "fifo",
+        "values": ["fifo", "priority"],
+        "label": "Front desk queue order"
+    },
+    "reschedule_same_patient": {
+        "type": "Checkbox",
+        "value": True,
+        "label": "Replanned patients keep their attributes"
+    },
     "use_ic_spike":  {
         "type": "Checkbox",
         "value": False,
@@ -0,0 +1,252 @@
+from lib.agents.patient import WAITING, AT_DESK, AT_DEPARTMENT, ADMITTED
+import numpy as np
+
+# States are stored as their index, free slots get the code after the last state
+STATES = [WAITING, AT_DESK, AT_DEPARTMENT, ADMITTED]
+WAITING_CODE, AT_DESK_CODE, AT_DEPARTMENT_CODE, ADMITTED_CODE, FREE_CODE = range(len(STATES) + 1)
+
+# Columns of the store, moments and indices that aren't set are -1
+COLUMNS = {
+    "used": bool, "unique_id": np.int64, "spec": np.int16, "age": np.int64, "gender": np.int8, "planned": bool, "pandemic": bool,
+    "state": np.int8, "queued_at": np.int64, "adm_icu": np.int64, "discharge_at": np.int64, "los_icu": np.int64,
+    "backup_los_icu": np.float64, "department": np.int16, "sickness": np.float64
+}
+
+# Text columns are stored as codes, the values get a code the first time they are seen
+CATEGORIES = ["spec", "gender"]
+
+
+class PatientStore:
+    """
+        Keeps the patients of a headless run in preallocated NumPy columns (struct of arrays) instead of one agent per patient.
+        The slots of patients that left are reused and the columns only grow, doubling, when every slot is taken, so the
+        memory stays flat over a run. The patients are stepped as a batch: each kind of state change is a mask over the
+        columns and only the patients that change state touch Python, admitted patients are left to their department.
+        The front desk, the departments and the event engine get a StoredPatient, a handle on a slot that looks like a Patient.
+        It pays off when many patients are in transit at once, like a long queue at a front desk that can't keep up: every
+        queued patient is an agent that is stepped each step, where the store looks at the whole queue with one mask.
+        With few patients in transit the agents are faster, reading a column costs more than reading an attribute.
+    """
+    def __init__(self, model, size: int = 1024) -> None:
+        self.model = model
+        self.columns = { name: np.zeros(size, dtype=dtype) if dtype is bool else np.full(size, -1, dtype=dtype) for name, dtype in COLUMNS.items() }
+        self.free_slots = []
+        # Slots from end on have never been used
+        self.end = 0
+        # Patients that aren't admitted, most steps there are none and the step has nothing to do
+        self.in_transit = 0
+        self.next_id = 1
+        self.categories = { name: [] for name in CATEGORIES }
+        self.codes = { name: {} for name in CATEGORIES }
+        self.departments = []
+        self.department_codes = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.columns["used"])
+
+    def __len__(self) -> int:
+        return self.end - len(self.free_slots)
+
+    def encode(self, name: str, value) -> int:
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(self.categories[name])
+            self.categories[name].append(value)
+        return codes[value]
+
+    def get_department_code(self, department) -> int:
+        if id(department) not in self.department_codes:
+            self.department_codes[id(department)] = len(self.departments)
+            self.departments.append(department)
+        return self.department_codes[id(department)]
+
+    def grow(self) -> None:
+        for name, values in self.columns.items():
+            grown = np.zeros(2 * len(values), dtype=values.dtype) if values.dtype == bool else np.full(2 * len(values), -1, dtype=values.dtype)
+            grown[:len(values)] = values
+            self.columns[name] = grown
+
+    def add(self, planned: bool, pandemic: bool, data: dict) -> "StoredPatient":
+        """Puts a new patient in a free slot, see Patient.__init__."""
+        if len(self.free_slots) > 0:
+            slot = self.free_slots.pop()
+        else:
+            if self.end == self.size:
+                self.grow()
+            slot = self.end
+            self.end += 1
+
+        columns = self.columns
+        for name in ["queued_at", "adm_icu", "discharge_at", "department"]:
+            columns[name][slot] = -1
+        columns["used"][slot] = True
+        columns["unique_id"][slot] = self.next_id
+        columns["spec"][slot] = self.encode("spec", str(data["ref_spec"]))
+        columns["age"][slot] = data["age"]
+        columns["gender"][slot] = self.encode("gender", str(data["gender"]))
+        columns["planned"][slot] = planned
+        columns["pandemic"][slot] = pandemic
+        columns["state"][slot] = WAITING_CODE
+        self.in_transit += 1
+        columns["los_icu"][slot] = int(data["los_icu"] * (24 * 3600))
+        columns["backup_los_icu"][slot] = data["los_icu"]
+        columns["sickness"][slot] = self.model.streams["sickness"].random()
+        self.next_id += 1
+
+        return StoredPatient(self, slot)
+
+    def set_state(self, slot: int, code: int) -> None:
+        self.in_transit += int(code < ADMITTED_CODE) - int(self.columns["state"][slot] < ADMITTED_CODE)
+        self.columns["state"][slot] = code
+
+    def release(self, slot: int) -> None:
+        self.in_transit -= int(self.columns["state"][slot] < ADMITTED_CODE)
+        self.columns["used"][slot] = False
+        self.columns["state"][slot] = FREE_CODE
+        self.free_slots.append(slot)
+
+    def get_ordered_slots(self, mask: np.ndarray) -> np.ndarray:
+        """The slots of the mask in the order their patients were created, slots are reused so that isn't the slot order."""
+        slots = np.flatnonzero(mask)
+        return slots[np.argsort(self.columns["unique_id"][slots], kind="stable")]
+
+    def get_patients(self) -> list["StoredPatient"]:
+        return [StoredPatient(self, slot) for slot in self.get_ordered_slots(self.columns["used"][:self.end])]
+
+    def go_to_front_desk(self, slot: int) -> None:
+        self.columns["state"][slot] = AT_DESK_CODE
+        self.model.get_front_desk().enqueue(StoredPatient(self, slot))
+
+    def admit(self, slots: np.ndarray) -> None:
+        """Admits the patients in the slots at once, see Patient.admit."""
+        columns = self.columns
+        clock = self.model.clock
+        codes = columns["department"][slots]
+        columns["adm_icu"][slots] = clock.elapsed
+        for code in np.unique(codes):
+            selected = slots[codes == code]
+            columns["discharge_at"][selected] = clock.elapsed + self.departments[code].get_time_until_discharge(columns["los_icu"][selected])
+        self.in_transit -= np.count_nonzero(columns["state"][slots] < ADMITTED_CODE)
+        columns["state"][slots] = ADMITTED_CODE
+
+        for slot in slots[columns["discharge_at"][slots] > clock.elapsed]:
+            self.departments[columns["department"][slot]].schedule_discharge(StoredPatient(self, slot))
+
+    def discharge(self, slot: int) -> None:
+        patient = StoredPatient(self, slot)
+        self.model.datacollector.add_table_row("admissions", { "ref_spec": patient.spec, "adm_icu": patient.adm_icu, "dis_icu": self.model.clock.elapsed, "los_icu": patient.backup_los_icu, "age": patient.age, "gender": patient.gender, "plan_adm": patient.planned })
+        patient.icu_department.free_capacity(patient)
+        self.release(slot)
+
+    def step(self, before_id: int) -> None:
+        """
+            Steps the patients created before before_id like Patient.step does, patients that arrived during the step of the
+            model are stepped from the next step on. Every patient makes one move and the moves don't depend on each other,
+            so they are done per kind, in the order the patients were created.
+        """
+        if self.in_transit == 0:
+            return
+
+        columns = self.columns
+        # Only the patients that aren't admitted move, which are few, so the rest of the work is on their slots only
+        slots = np.flatnonzero(columns["state"][:self.end] < ADMITTED_CODE)
+        slots = slots[columns["unique_id"][slots] < before_id]
+        if len(slots) == 0:
+            return
+
+        slots = slots[np.argsort(columns["unique_id"][slots])]
+        states = columns["state"][slots]
+        admitted = slots[states == AT_DEPARTMENT_CODE]
+        waiting = slots[states == WAITING_CODE]
+        columns["state"][slots[(states == AT_DESK_CODE) & (columns["department"][slots] >= 0)]] = AT_DEPARTMENT_CODE
+
+        if len(admitted) > 0:
+            self.admit(admitted)
+            # A stay that ends in the step of the admission
+            for slot in admitted[columns["discharge_at"][admitted] <= self.model.clock.elapsed]:
+                self.discharge(slot)
+
+        for slot in waiting:
+            self.go_to_front_desk(slot)
+
+
+def column_property(name: str, optional: bool = False) -> property:
+    """An attribute of a StoredPatient that reads and writes its column, optional ones are None when not set."""
+    def get(self):
+        value = self.store.columns[name][self.slot].item()
+        return None if optional and value == -1 else value
+
+    def set(self, value) -> None:
+        self.store.columns[name][self.slot] = -1 if optional and value is None else value
+
+    return property(get, set)
+
+
+class StoredPatient:
+    """Handle on a slot of the patient store with the attributes and methods of a Patient, it's only valid while the patient is in the store."""
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store: PatientStore, slot: int) -> None:
+        self.store = store
+        self.slot = slot
+
+    unique_id = column_property("unique_id")
+    age = column_property("age")
+    planned = column_property("planned")
+    los_icu = column_property("los_icu")
+    backup_los_icu = column_property("backup_los_icu")
+    sickness = column_property("sickness")
+    queued_at = column_property("queued_at", optional=True)
+    adm_icu = column_property("adm_icu", optional=True)
+    discharge_at = column_property("discharge_at", optional=True)
+
+    @property
+    def spec(self) -> str:
+        return self.store.categories["spec"][self.store.columns["spec"][self.slot]]
+
+    @property
+    def gender(self) -> str:
+        return self.store.categories["gender"][self.store.columns["gender"][self.slot]]
+
+    @property
+    def bed_type(self) -> str:
+        return "pandemic" if self.store.columns["pandemic"][self.slot] else "normal"
+
+    @property
+    def state(self) -> str:
+        return STATES[self.store.columns["state"][self.slot]]
+
+    @state.setter
+    def state(self, state: str) -> None:
+        self.store.set_state(self.slot, STATES.index(state))
+
+    @property
+    def is_in_icu(self) -> bool:
+        return self.state == ADMITTED
+
+    @property
+    def icu_department(self):
+        code = self.store.columns["department"][self.slot]
+        return self.store.departments[code] if code >= 0 else None
+
+    def set_icu_department(self, department) -> None:
+        self.store.columns["department"][self.slot] = self.store.get_department_code(department)
+
+    def get_data(self) -> dict:
+        return { "ref_spec": self.spec, "age": self.age, "gender": self.gender, "los_icu": self.backup_los_icu }
+
+    def go_to_front_desk(self) -> None:
+        self.store.go_to_front_desk(self.slot)
+
+    def go_to_department(self) -> None:
+        self.state = AT_DEPARTMENT
+
+    def admit(self) -> None:
+        self.store.admit(np.array([self.slot]))
+
+    def discharge(self) -> None:
+        self.store.discharge(self.slot)
+
+    def remove(self) -> None:
+        self.store.release(self.slot)
@@ -0,0 +1,45 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+import pandas as pd
+
+
+class Profiler:
+    """
+        Keeps the cumulative wall time and amount of calls of named parts of a run, grouped by category:
+        the phases of a step, the agent types or the event kinds of the event engine.
+        It is only created when a model is profiled, so unprofiled runs don't pay for the timers.
+    """
+    def __init__(self) -> None:
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def add(self, category: str, name: str, seconds: float) -> None:
+        self.seconds[(category, name)] += seconds
+        self.calls[(category, name)] += 1
+
+    @contextmanager
+    def measure(self, category: str, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(category, name, perf_counter() - start)
+
+    def step_agent(self, agent) -> None:
+        """Steps an agent and books the time on its type, pass it to AgentSet.do to keep the order agents are stepped in."""
+        start = perf_counter()
+        agent.step()
+        self.add("agent", type(agent).__name__, perf_counter() - start)
+
+    def get_dataframe(self) -> pd.DataFrame:
+        """One row per category and name with the calls, total and mean seconds and the share of the time of its category."""
+        dataframe = pd.DataFrame(
+            [{ "category": category, "name": name, "calls": self.calls[(category, name)], "total_seconds": seconds }
+             for (category, name), seconds in self.seconds.items()],
+            columns=["category", "name", "calls", "total_seconds"]
+        )
+        dataframe["mean_seconds"] = dataframe["total_seconds"] / dataframe["calls"]
+        dataframe["share"] = dataframe["total_seconds"] / dataframe.groupby("category")["total_seconds"].transform("sum")
+
+        return dataframe.sort_values(["category", "total_seconds"], ascending=[True, False], ignore_index=True)
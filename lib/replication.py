@@ -0,0 +1,111 @@
+from statistics import NormalDist
+from lib.agents import Department
+import numpy as np
+import pandas as pd
+
+# Two-sided Student-t quantiles by confidence, for 1 up to 30 degrees of freedom
+T_QUANTILES = {
+    0.90: [6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812, 1.796, 1.782, 1.771, 1.761, 1.753,
+           1.746, 1.740, 1.734, 1.729, 1.725, 1.721, 1.717, 1.714, 1.711, 1.708, 1.706, 1.703, 1.701, 1.699, 1.697],
+    0.95: [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+           2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042],
+    0.99: [63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169, 3.106, 3.055, 3.012, 2.977, 2.947,
+           2.921, 2.898, 2.878, 2.861, 2.845, 2.831, 2.819, 2.807, 2.797, 2.787, 2.779, 2.771, 2.763, 2.756, 2.750]
+}
+
+def get_t_quantile(confidence: float, df: int) -> float:
+    """
+        Two-sided Student-t quantile, looked up in T_QUANTILES. Other confidences and more degrees of freedom use the
+        Cornish-Fisher expansion around the normal quantile, which is within 0.001 of the table from 30 degrees of freedom on.
+    """
+    confidence = round(confidence, 4)
+    if confidence in T_QUANTILES and df <= len(T_QUANTILES[confidence]):
+        return T_QUANTILES[confidence][df - 1]
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+class RunningStatistics:
+    """Keeps the mean and variance of a stream of values with Welford's online algorithm."""
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(self.variance)
+
+    def get_half_width(self, confidence: float = 0.95) -> float:
+        """Half width of the Student-t confidence interval of the mean, replications are few so the normal one is too narrow."""
+        if self.count < 2:
+            return np.nan
+
+        return get_t_quantile(confidence, self.count - 1) * self.std / np.sqrt(self.count)
+
+
+class ReplicationAggregator:
+    """
+        Aggregates the KPIs of the replications of one parameter set as they come in.
+        With a precision set, the parameter set is converged once the confidence interval half width of every KPI
+        is at most that fraction of its mean. KPIs that were zero in every replication so far, like the refusals of a
+        specialism that is never refused, have no relative precision to reach: they're left out instead of passing with a
+        zero half width, and a parameter set with only such KPIs runs all its replications.
+    """
+    def __init__(self, confidence: float = 0.95, precision: float = None, min_replications: int = 3) -> None:
+        self.confidence = confidence
+        self.precision = precision
+        self.min_replications = max(min_replications, 2)
+        self.statistics: dict[str, RunningStatistics] = {}
+
+    @property
+    def count(self) -> int:
+        return min([x.count for x in self.statistics.values()], default=0)
+
+    def add(self, kpis: dict[str, float]) -> None:
+        for key, value in kpis.items():
+            if key not in self.statistics:
+                self.statistics[key] = RunningStatistics()
+            self.statistics[key].add(value)
+
+    def is_converged(self) -> bool:
+        if self.precision is None or self.count < self.min_replications:
+            return False
+
+        statistics = [x for x in self.statistics.values() if x.mean != 0]
+        return len(statistics) > 0 and all([x.get_half_width(self.confidence) <= self.precision * abs(x.mean) for x in statistics])
+
+    def get_summary_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame([{
+            "kpi": key,
+            "mean": statistics.mean,
+            "std": statistics.std,
+            "half_width": statistics.get_half_width(self.confidence),
+            "replications": statistics.count
+        } for key, statistics in self.statistics.items()])
+
+
+def calculate_kpis(model) -> dict[str, float]:
+    """Reduces a finished run to the KPIs that are compared between replications."""
+    refused = model.datacollector.get_table_dataframe("refused")
+    costs = model.datacollector.get_table_dataframe("costs")
+    total_capacity = sum([department.capacity for department in model.agents_by_type[Department]])
+
+    kpis = { f"refused_{spec}": float((refused["ref_spec"] == spec).sum()) for spec in model.datamanager.OPTIONS.keys() }
+    kpis["refused"] = float(len(refused))
+    kpis["replanning"] = float(len(model.datacollector.get_table_dataframe("replanning")))
+    kpis["mean_occupancy"] = float(total_capacity - costs["amount_empty_beds"].mean()) if len(costs) > 0 else 0.0
+    kpis["cumulative_costs"] = float(costs["cumulative_hourly_costs"].sum())
+
+    return kpis
@@ -0,0 +1,77 @@
+from lib.datacollection import ColumnarDataCollector, CategoryColumn, TimeColumn, format_times, decode_categories
+from lib.utils import Clock
+import numpy as np
+import pandas as pd
+import json
+
+# Bump when the layout of the result files changes
+RESULTS_VERSION = 1
+
+
+def export_tables(datacollector: ColumnarDataCollector, table_names: list[str]) -> dict:
+    """
+        Takes the raw columns of the tables out of the datacollector: seconds for moments and codes for categories,
+        together with the schema needed to turn them back into the DataFrames of get_table_dataframe.
+    """
+    arrays = {}
+    schema = {}
+    for table in table_names:
+        schema[table] = {}
+        for column, values in datacollector.tables[table].items():
+            key = f"{table}/{column}"
+            if isinstance(values, CategoryColumn):
+                schema[table][column] = { "kind": "category", "categories": [str(x) for x in values.categories] }
+                arrays[key] = values.get_values().copy()
+            elif isinstance(values, TimeColumn):
+                schema[table][column] = { "kind": "time" }
+                arrays[key] = values.get_values().copy()
+            elif values.values.dtype == object:
+                # Untyped columns are stored as text, so the file can be read without pickle
+                schema[table][column] = { "kind": "text" }
+                arrays[key] = values.get_values().astype(str)
+            else:
+                schema[table][column] = { "kind": "value" }
+                arrays[key] = values.get_values().copy()
+
+    return { "arrays": arrays, "schema": schema }
+
+def save_results(path: str, exported: dict, metadata: dict = None) -> None:
+    """Writes exported tables to one compressed .npz file, with the metadata (config, seed, ...) embedded as json."""
+    header = {
+        "version": RESULTS_VERSION,
+        "schema": exported["schema"],
+        "metadata": metadata if metadata is not None else {}
+    }
+
+    with open(path, "wb") as file:
+        np.savez_compressed(file, __header__=np.array(json.dumps(header, default=str)), **exported["arrays"])
+
+def load_results(path: str, format_dates: bool = True) -> tuple[dict[str, pd.DataFrame], dict]:
+    """
+        Reads a file written by save_results back into the DataFrames get_table_dataframe returned, and its metadata.
+        Without format_dates moments stay seconds since the start of the run, which is quicker to analyse.
+    """
+    with np.load(path, allow_pickle=False) as file:
+        header = json.loads(str(file["__header__"]))
+        if header["version"] != RESULTS_VERSION:
+            raise ValueError(f"{path} has result format version {header['version']}, expected {RESULTS_VERSION}")
+
+        metadata = header["metadata"]
+        clock = Clock(start_year=metadata.get("start_year", 2025))
+
+        tables = {}
+        for table, columns in header["schema"].items():
+            data = {}
+            for column, description in columns.items():
+                values = file[f"{table}/{column}"]
+                if description["kind"] == "category":
+                    values = decode_categories(values, description["categories"])
+                elif description["kind"] == "time" and format_dates:
+                    values = format_times(values, clock.format_time)
+                elif description["kind"] == "text":
+                    values = values.astype(object)
+                data[column] = values
+
+            tables[table] = pd.DataFrame(data)
+
+    return tables, metadata
@@ -0,0 +1,154 @@
+from itertools import count
+import heapq
+import numpy as np
+
+# Returned when nothing is due, which is most steps
+NOTHING_DUE = ()
+
+
+class ArrivalSchedule:
+    """
+        Sorted arrival timestamps (seconds into the day) for every day of a year, with a cursor per day that points at
+        the first arrival that hasn't been released yet. Releasing every arrival that is due is a single searchsorted
+        and moving the cursor, so the arrays are never copied while a day is played out.
+        Arrivals added later, like replanned patients, go on a heap per day so adding one is O(log n), and the amount
+        of arrivals left per day is kept up to date so counting a day is O(1).
+        Optional values, like a pandemic flag or the attributes of a replanned patient, are returned on release.
+    """
+    def __init__(self, days: int, values_dtype = None) -> None:
+        self.values_dtype = values_dtype
+        self.timestamps = [np.zeros(0, dtype=int) for _ in range(days)]
+        self.values = [np.zeros(0, dtype=values_dtype) for _ in range(days)] if values_dtype is not None else None
+        self.cursors = [0] * days
+        self.inserted = [[] for _ in range(days)]
+        self.counts = [0] * days
+        self.counter = count()
+
+    @classmethod
+    def from_counts(cls, counts: np.ndarray, timestamps: np.ndarray, values: np.ndarray = None) -> "ArrivalSchedule":
+        """Builds a schedule from the arrivals of all days at once, ordered by day, counts holding the amount per day."""
+        schedule = cls(len(counts), values.dtype if values is not None else None)
+
+        # Sort by day first and timestamp second, stable so arrivals with the same timestamp keep their order
+        day_ids = np.repeat(np.arange(len(counts)), counts)
+        order = np.lexsort((timestamps, day_ids))
+        splits = np.cumsum(counts)[:-1]
+
+        schedule.timestamps = np.split(np.asarray(timestamps)[order], splits)
+        if values is not None:
+            schedule.values = np.split(np.asarray(values)[order], splits)
+        schedule.counts = [int(x) for x in counts]
+
+        return schedule
+
+    @property
+    def days(self) -> int:
+        return len(self.timestamps)
+
+    def __contains__(self, day: int) -> bool:
+        return 0 < day <= len(self.counts)
+
+    def __getitem__(self, day: int) -> np.ndarray:
+        """The timestamps of the day that haven't been released yet."""
+        index = day - 1
+        remaining = self.timestamps[index][self.cursors[index]:]
+        if len(self.inserted[index]) == 0:
+            return remaining
+
+        return np.sort(np.concatenate((remaining, [x[0] for x in self.inserted[index]])))
+
+    def __setitem__(self, day: int, timestamps) -> None:
+        index = day - 1
+        self.timestamps[index] = np.sort(np.asarray(timestamps, dtype=int))
+        if self.values is not None:
+            self.values[index] = np.zeros(len(timestamps), dtype=self.values_dtype)
+        self.cursors[index] = 0
+        self.inserted[index] = []
+        self.counts[index] = len(timestamps)
+
+    def count(self, day: int) -> int:
+        """Amount of arrivals of the day that haven't been released yet."""
+        return self.counts[day - 1] if 0 < day <= len(self.counts) else 0
+
+    def release(self, day: int, timestamp: int):
+        """
+            Releases every arrival of the day at or before the timestamp. Returns the value of each arrival,
+            None for arrivals without a value.
+        """
+        if day not in self:
+            return NOTHING_DUE
+
+        index = day - 1
+        cursor = self.cursors[index]
+        timestamps = self.timestamps[index]
+        inserted = self.inserted[index]
+        base_due = cursor < len(timestamps) and timestamps[cursor] <= timestamp
+        if not base_due and (len(inserted) == 0 or inserted[0][0] > timestamp):
+            return NOTHING_DUE
+
+        released = []
+        if base_due:
+            end = int(np.searchsorted(timestamps, timestamp, side="right"))
+            self.cursors[index] = end
+            released = self.values[index][cursor:end].tolist() if self.values is not None else [None] * (end - cursor)
+
+        while len(inserted) > 0 and inserted[0][0] <= timestamp:
+            released.append(heapq.heappop(inserted)[2])
+
+        self.counts[index] -= len(released)
+        return released
+
+    def insert(self, day: int, timestamp: int, value = None) -> None:
+        """Adds an arrival to the day, an arrival added to today at the current time is released by the next release."""
+        index = day - 1
+        heapq.heappush(self.inserted[index], (int(timestamp), next(self.counter), value))
+        self.counts[index] += 1
+
+    def insert_from(self, schedule: "ArrivalSchedule") -> None:
+        """Adds the arrivals that were added to another schedule, in the order they would be released from it."""
+        for index, inserted in enumerate(schedule.inserted):
+            for timestamp, _, value in sorted(inserted, key=lambda x: x[:2]):
+                self.insert(index + 1, timestamp, value)
+
+    def get_state(self) -> dict[str, np.ndarray]:
+        """
+            The arrivals that haven't been released yet as flat arrays, restored by from_state. Arrivals added later are kept
+            in the order they are released, their values have to be None or dicts of patient attributes.
+        """
+        remaining = [timestamps[cursor:] for timestamps, cursor in zip(self.timestamps, self.cursors)]
+        inserted = [(day + 1, *entry) for day, heap in enumerate(self.inserted) for entry in sorted(heap, key=lambda x: x[:2])]
+        data = [x[3] for x in inserted]
+
+        state = {
+            "counts": np.array([len(x) for x in remaining], dtype=int),
+            "timestamps": np.concatenate(remaining).astype(int),
+            "inserted_day": np.array([x[0] for x in inserted], dtype=int),
+            "inserted_timestamp": np.array([x[1] for x in inserted], dtype=int),
+            "inserted_has_data": np.array([x is not None for x in data], dtype=bool)
+        }
+        # Arrivals without data get empty attributes, inserted_has_data tells them apart
+        for key, empty in [("ref_spec", ""), ("age", 0), ("gender", ""), ("los_icu", 0.0)]:
+            state[f"inserted_{key}"] = np.array([x[key] if x is not None else empty for x in data], dtype=type(empty))
+        if self.values is not None:
+            state["values"] = np.concatenate([values[cursor:] for values, cursor in zip(self.values, self.cursors)])
+
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict[str, np.ndarray]) -> "ArrivalSchedule":
+        values = state.get("values")
+        schedule = cls(len(state["counts"]), values.dtype if values is not None else None)
+
+        splits = np.cumsum(state["counts"])[:-1]
+        schedule.timestamps = np.split(state["timestamps"], splits)
+        if values is not None:
+            schedule.values = np.split(values, splits)
+        schedule.counts = [int(x) for x in state["counts"]]
+
+        for i in range(len(state["inserted_day"])):
+            data = None
+            if state["inserted_has_data"][i]:
+                data = { key: state[f"inserted_{key}"][i].item() for key in ["ref_spec", "age", "gender", "los_icu"] }
+            schedule.insert(int(state["inserted_day"][i]), int(state["inserted_timestamp"][i]), data)
+
+        return schedule
@@ -0,0 +1,201 @@
+from lib.agents import Patient, Frontdesk, Department, Home
+from lib.agents.patient import AT_DESK, AT_DEPARTMENT, ADMITTED
+from lib.agents.department import BED_TYPES
+from lib.schedule import ArrivalSchedule
+from lib.streams import create_streams
+from itertools import count
+import heapq
+import numpy as np
+import json
+
+# Bump when the layout of the snapshot files changes
+SNAPSHOT_VERSION = 3
+
+# Patient attributes that are stored as they are, missing moments and indices are stored as -1
+PATIENT_COLUMNS = ["spec", "age", "gender", "planned", "los_icu", "backup_los_icu", "bed_type", "sickness"]
+
+
+def create_snapshot(model) -> dict:
+    """
+        The full state of a model at the end of a step: the clock, the patients with their remaining length of stay, the beds,
+        the queue of the front desk, the arrivals that are still to come, the random streams and the amount of rows of every
+        table. Stepped and event driven models give the same snapshot, so a snapshot of one can be restored in the other.
+    """
+    departments = list(model.agents_by_type[Department])
+    department_indices = { id(x): i for i, x in enumerate(departments) }
+    frontdesk = model.agents_by_type[Frontdesk][0]
+    queue_positions = { entry[2].unique_id: i for i, entry in enumerate(sorted(frontdesk.queue, key=lambda x: x[:2])) }
+
+    patients = model.get_patients()
+    columns = { key: [] for key in PATIENT_COLUMNS + ["state", "queued_at", "adm_icu", "department", "bed", "queue_position"] }
+    for patient in patients:
+        department = patient.icu_department
+        state = patient.state
+        los_icu = patient.los_icu
+        # A patient that got a bed but hasn't reached it is admitted on the next step in both modes
+        if state == AT_DESK and department is not None:
+            state = AT_DEPARTMENT
+        # The length of stay isn't counted down, the moment of discharge gives what is left
+        if state == ADMITTED:
+            los_icu = (patient.discharge_at - model.clock.elapsed) // model.clock.clock_speed * department.get_los_rate()
+
+        for key in PATIENT_COLUMNS:
+            columns[key].append(getattr(patient, key))
+        columns["los_icu"][-1] = los_icu
+        columns["state"].append(state)
+        columns["queued_at"].append(patient.queued_at if patient.queued_at is not None else -1)
+        columns["adm_icu"].append(patient.adm_icu if patient.adm_icu is not None else -1)
+        columns["department"].append(department_indices[id(department)] if department is not None else -1)
+        columns["bed"].append(department.patient_beds.get(patient.unique_id, -1) if department is not None else -1)
+        columns["queue_position"].append(queue_positions.get(patient.unique_id, -1))
+
+    arrays = { f"patients/{key}": np.array(values, dtype=str if key in ["spec", "gender", "bed_type", "state"] else None) for key, values in columns.items() }
+    # Text is stored as fixed width strings, so the file can be read without pickle
+    for name, buffer in model.patient_buffers.items():
+        arrays.update({ f"patient_buffers/{name}/{key}": values.astype(str) if values.dtype == object else values for key, values in buffer.items() })
+    for i, department in enumerate(departments):
+        arrays[f"departments/{i}/bed_types"] = department.bed_types
+        for bed_type, beds in department.free_beds.items():
+            arrays[f"departments/{i}/free_{bed_type}"] = np.array(beds, dtype=int)
+    for name in ["agent_schedules", "unplanned_schedules", "next_agent_schedules"]:
+        arrays.update({ f"{name}/{key}": values for key, values in getattr(model, name).get_state().items() })
+
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "parameters": model.parameters,
+        "elapsed": model.clock.elapsed,
+        "steps": model.steps,
+        "model": {
+            "current_year": model.current_year,
+            "current_hour": model.current_hour,
+            "current_day": model.current_day,
+            "cumulative_hourly_costs": model.cumulative_hourly_costs,
+            "cumulative_daily_costs": model.cumulative_daily_costs,
+            "patient_buffer_indices": model.patient_buffer_indices
+        },
+        "home_day": model.agents_by_type[Home][0].current_day,
+        "streams": { name: stream.bit_generator.state for name, stream in model.streams.items() },
+        # The tables of a restored model start empty, these are the rows the run had up to the snapshot
+        "table_offsets": { table: len(next(iter(columns.values()), [])) for table, columns in model.datacollector.tables.items() }
+    }
+
+    return { "header": header, "arrays": arrays }
+
+def restore_beds(department: Department, patients: list[Patient], beds: list[int], free_beds: dict[str, np.ndarray], bed_types: np.ndarray) -> None:
+    """Puts the patients back in their beds, or in the first free beds of their type when the beds of the department changed."""
+    if np.array_equal(department.bed_types, bed_types):
+        department.free_beds = { bed_type: [int(x) for x in beds] for bed_type, beds in free_beds.items() }
+    else:
+        beds = []
+        for patient in patients:
+            for bed_type in department.get_bed_type_order(patient):
+                if len(department.free_beds[bed_type]) > 0:
+                    beds.append(department.free_beds[bed_type].pop(0))
+                    break
+            else:
+                raise ValueError(f"Department {', '.join(department.specs)} has {len(patients)} patients in the snapshot, more than its {department.capacity} beds")
+
+    for patient, bed in zip(patients, beds):
+        department.bed_occupants[bed] = patient.unique_id
+        department.patient_beds[patient.unique_id] = int(bed)
+    department.current_capacity = len(department.bed_types) - len(patients)
+
+def restore_snapshot(model, snapshot: dict, reseed: bool = False) -> None:
+    """Puts a newly created model in the state of the snapshot, see ICUModel.from_snapshot."""
+    header, arrays = snapshot["header"], snapshot["arrays"]
+    if header["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot has version {header['version']}, expected {SNAPSHOT_VERSION}")
+    if [list(x) for x in model.departments.value] != header["parameters"]["departments"]:
+        raise ValueError("The department groups of a model restored from a snapshot have to be the same as in the snapshot")
+
+    model.clock.elapsed = header["elapsed"]
+    model.clock.update_fields()
+    model.steps = header["steps"]
+    for key, value in header["model"].items():
+        setattr(model, key, value)
+    # Every model restored from the same snapshot moves through the buffers on its own
+    model.patient_buffer_indices = dict(model.patient_buffer_indices)
+    model.patient_buffers = { name: { key.split("/", 2)[2]: values for key, values in arrays.items() if key.startswith(f"patient_buffers/{name}/") } for name in model.patient_buffers }
+    for name in ["agent_schedules", "unplanned_schedules", "next_agent_schedules"]:
+        setattr(model, name, ArrivalSchedule.from_state({ key.split("/", 1)[1]: values for key, values in arrays.items() if key.startswith(f"{name}/") }))
+    model.agents_by_type[Home][0].current_day = header["home_day"]
+
+    departments = list(model.agents_by_type[Department])
+    frontdesk = model.agents_by_type[Frontdesk][0]
+    home = model.agents_by_type[Home][0]
+    department_patients = [[] for _ in departments]
+    department_beds = [[] for _ in departments]
+    queue = []
+
+    # Patients are created in the order they were stepped in, which is the order they are created in
+    columns = { key.split("/", 1)[1]: values for key, values in arrays.items() if key.startswith("patients/") }
+    for i in range(len(columns["state"])):
+        if model.patient_store is not None:
+            data = { "ref_spec": str(columns["spec"][i]), "age": columns["age"][i].item(), "gender": str(columns["gender"][i]), "los_icu": columns["backup_los_icu"][i].item() }
+            patient = model.patient_store.add(bool(columns["planned"][i]), str(columns["bed_type"][i]) == "pandemic", data)
+        else:
+            patient = Patient(model, age=columns["age"][i].item(), gender=str(columns["gender"][i]), planned=bool(columns["planned"][i]), spec=str(columns["spec"][i]),
+                              los_icu=columns["backup_los_icu"][i].item(), bed_type=str(columns["bed_type"][i]))
+        patient.los_icu = int(columns["los_icu"][i])
+        patient.sickness = float(columns["sickness"][i])
+        patient.state = str(columns["state"][i])
+        patient.queued_at = int(columns["queued_at"][i]) if columns["queued_at"][i] >= 0 else None
+        patient.adm_icu = int(columns["adm_icu"][i]) if columns["adm_icu"][i] >= 0 else None
+
+        position = home.pos
+        if columns["department"][i] >= 0:
+            department = departments[columns["department"][i]]
+            patient.set_icu_department(department)
+            department_patients[columns["department"][i]].append(patient)
+            department_beds[columns["department"][i]].append(int(columns["bed"][i]))
+            position = department.pos if patient.state in [AT_DEPARTMENT, ADMITTED] else frontdesk.row_pos
+            # The rest of the stay is worked out again, the efficiency of the restored model may differ
+            if patient.state == ADMITTED:
+                patient.discharge_at = model.clock.elapsed + int(department.get_time_until_discharge(patient.los_icu, admitted=True))
+                model.patients_in_transit.pop(patient, None)
+                department.schedule_discharge(patient)
+        elif patient.state == AT_DESK:
+            position = frontdesk.row_pos
+        if columns["queue_position"][i] >= 0:
+            queue.append((columns["queue_position"][i], patient))
+        # Patients in the store only have their state
+        if model.patient_store is None:
+            patient.is_in_icu = patient.state == ADMITTED
+            model.place_agent(patient, position)
+
+    for i, department in enumerate(departments):
+        free_beds = { bed_type: arrays[f"departments/{i}/free_{bed_type}"] for bed_type in BED_TYPES }
+        restore_beds(department, department_patients[i], department_beds[i], free_beds, arrays[f"departments/{i}/bed_types"])
+
+    frontdesk.queue = []
+    frontdesk.queue_counter = count()
+    for _, patient in sorted(queue, key=lambda x: x[0]):
+        priority = int(patient.planned) if frontdesk.queue_discipline == "priority" else 0
+        heapq.heappush(frontdesk.queue, (priority, next(frontdesk.queue_counter), patient))
+
+    # The streams are restored last, creating the patients above draws from them
+    if reseed:
+        model.streams = create_streams(model.parameters["seed"])
+    else:
+        for name, state in header["streams"].items():
+            model.streams[name].bit_generator.state = state
+
+    # The tables only get the rows after the snapshot, the first row of the model variables is the restored state
+    model.datacollector = model.create_datacollector()
+    model.datacollector.collect(model)
+    model.table_offsets = header["table_offsets"]
+
+    if model.engine is not None:
+        model.engine.resume()
+
+def save_snapshot(path: str, snapshot: dict) -> None:
+    """Writes a snapshot to one compressed .npz file, the header is embedded as json."""
+    with open(path, "wb") as file:
+        np.savez_compressed(file, __header__=np.array(json.dumps(snapshot["header"])), **snapshot["arrays"])
+
+def load_snapshot(path: str) -> dict:
+    with np.load(path, allow_pickle=False) as file:
+        header = json.loads(str(file["__header__"]))
+        arrays = { key: file[key] for key in file.files if key != "__header__" }
+
+    return { "header": header, "arrays": arrays }
@@ -0,0 +1,16 @@
+import numpy as np
+
+# Every source of randomness in the model draws from its own stream, new streams are only ever added at the end
+# so the existing streams of a seed stay the same
+STREAMS = ("arrivals", "patients", "los", "rescheduling", "beds", "sickness", "spike_arrivals", "spike_patients", "spike_los")
+
+
+def create_streams(seed = None) -> dict[str, np.random.Generator]:
+    """
+        Derives an independent generator for every stream from the seed. A stream is only used for one kind of draw,
+        so changing a parameter that makes one process draw more or less doesn't shift the draws of the other processes.
+        Models with the same seed see the same arrivals and patients whatever their capacity or planning method
+        (common random numbers), which makes the difference between scenarios much less noisy.
+    """
+    sequences = np.random.SeedSequence(seed).spawn(len(STREAMS))
+    return { name: np.random.default_rng(sequence) for name, sequence in zip(STREAMS, sequences) }
@@ -1,96 +1,84 @@
 import pandas as pd
 import numpy as np
 from typing import List, Callable
+from datetime import date, datetime, timedelta
+import calendar
+import hashlib
+import json
 import os
+import warnings
+
+# Source files of the DataManager and the on-disk cache of their preprocessed contents
+DATA_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+SOURCE_FILES = {
+    "opnames": os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "opnames.csv")),
+    "covid_data": os.path.join(DATA_FOLDER, "COVID-19_ic_opnames.csv")
+}
+CACHE_FILE = os.path.join(DATA_FOLDER, ".cache", "preprocessed.npz")
+# The covid data holds the IC admissions of the whole of the Netherlands. There were 1150 IC beds, upscaled to 1350 when
+# covid hit, applying that growth to the around 32 IC beds of the AMC gives the share of the admissions that went to the AMC
+ICU_SPIKE_SCALE = int(1350 * (32 / 1150)) / 1350
+# Bump when the preprocessing changes, so caches written by older code are rebuilt
+CACHE_VERSION = 2
 
 class Clock:
-    def __init__(self, clock_speed: int = 1) -> None:
-        self.clock_speed = clock_speed * 60
-        self.second = 0
-        self.minute = 0
-        self.hour = 0
-        self.day = 1
-        self.month = 1
-        self.year = 25
-
-        self.month_mapping = {
-            1: 31,
-            2: 28,
-            3: 31,
-            4: 30,
-            5: 31,
-            6: 30,
-            7: 31,
-            8: 31,
-            9: 30,
-            10: 31,
-            11: 30,
-            12: 31
-        }
-        self.day_index = 1
+    """
+        Keeps the simulated time as a single integer of seconds since 2025/01/01 00:00:00. The time of day is derived
+        from it on every advance, the calendar fields (day, month, year, day_index) only when a new day starts.
+        Leap years are taken into account, strings are only built by get_time and format_time.
+    """
+    def __init__(self, clock_speed: int = 1, start_year: int = 2025) -> None:
+        self.clock_speed = int(clock_speed * 60)
+        self.start = date(start_year, 1, 1)
+        self.elapsed = 0
+        self.days = -1
 
         self.year_switch_events: List[Callable] = []
-    
+        self.update_fields()
+
     def step(self) -> None:
-        self.add_second()
+        self.advance(self.clock_speed)
 
     def add_second(self) -> None:
-        self.second += self.clock_speed
-        if(self.second >= 60):
-            multiplier = int(self.second / 60)
-            self.second = 0
-            self.add_minute(multiplier)
-
-    def add_minute(self, multiplier) -> None:
-        self.minute += multiplier
-        if(self.minute >= 60):
-            tmp = int(self.minute / 60)
-            self.minute = 0
-            self.add_hour(multiplier=tmp)
-
-    def add_hour(self, multiplier) -> None:
-        self.hour += multiplier
-        if(self.hour >= 24):
-            tmp = int(self.hour / 24)
-            self.hour = 0
-            self.add_day(multiplier=tmp)
-
-    def add_day(self, multiplier) -> None:
-        self.day_index += 1
-        if(self.day_index >= 366):
-            self.day_index = 1
-        self.day += multiplier
-        if (self.day >= self.month_mapping[self.month] + 1):
-            tmp = int(self.day / (self.month_mapping[self.month] + 1))
-            self.day = 1
-            self.add_month(multiplier=tmp)
-
-    def add_month(self, multiplier) -> None:
-        self.month += multiplier
-        if(self.month >= 13):
-            tmp = int(self.month / 12)
-            self.month = 1
-            self.add_year(multiplier=tmp)
-
-    def add_year(self, multiplier) -> None:
-        self.year += multiplier
-        if (self.year >= 100):
-            self.year = 0
-            for event in self.year_switch_events:
-                event()
+        """Moves the clock one step, kept for compatibility."""
+        self.advance(self.clock_speed)
+
+    def advance(self, seconds: int) -> None:
+        """Moves the clock forward by an arbitrary amount of seconds."""
+        self.elapsed += seconds
+        self.update_fields()
+
+    def update_fields(self) -> None:
+        days, day_timestamp = divmod(self.elapsed, self.seconds_in_day)
+        self.hour, rest = divmod(day_timestamp, 3600)
+        self.minute, self.second = divmod(rest, 60)
+
+        if days != self.days:
+            self.days = days
+            current = self.start + timedelta(days=days)
+            previous_year = getattr(self, "full_year", current.year)
+
+            self.day = current.day
+            self.month = current.month
+            self.full_year = current.year
+            self.year = current.year % 100
+            self.day_index = current.timetuple().tm_yday
+            self.days_in_year = 366 if calendar.isleap(current.year) else 365
+
+            if self.full_year != previous_year:
+                for event in self.year_switch_events:
+                    event()
 
     def get_day_timestamp(self) -> int:
-        return self.second + self.minute * 60 + self.hour * 3600
+        return self.elapsed % self.seconds_in_day
 
-    def get_time(self, full: bool = False) -> None:
-        s = "{:02d}".format(self.second)
-        m = "{:02d}".format(self.minute)
-        h = "{:02d}".format(self.hour)
-        d = "{:02d}".format(self.day)
-        mo = "{:02d}".format(self.month)
-        y = "{:02d}".format(self.year)
+    def get_time(self, full: bool = False) -> str:
+        return self.format_time(self.elapsed, full)
 
-        return f"20{y}/{mo}/{d} {h}:{m}:{s}" if full else f"{d}/{mo}/{y} {h}:{m}:{s}" 
+    def format_time(self, elapsed: int, full: bool = True) -> str:
+        """Formats a moment given in seconds since the start of the clock, like 2025/01/31 13:10:00 or 31/01/25 13:10:00."""
+        moment = datetime(self.start.year, self.start.month, self.start.day) + timedelta(seconds=int(elapsed))
+        return moment.strftime("%Y/%m/%d %H:%M:%S") if full else moment.strftime("%d/%m/%y %H:%M:%S")
     
     @property
     def seconds_in_day (self):
@@ -104,16 +92,71 @@ def get_color (x: float) -> tuple[float, float, float]:
     return (r, g, b)
 
 
-class DataManager:
-    def __init__(self) -> None:
-        # Dynamisch pad berekenen voor opnames.csv
-        opnames_full_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "opnames.csv"))
+def get_source_signature() -> tuple:
+    """Size and modification time of every source file, a change means the preprocessed data may be outdated."""
+    return tuple((name, os.stat(path).st_size, os.stat(path).st_mtime_ns) for name, path in SOURCE_FILES.items())
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def read_cache() -> dict[str, np.ndarray]:
+    """Returns the cached columns, or None when there is no cache or its source files changed."""
+    if not os.path.exists(CACHE_FILE):
+        return None
+
+    try:
+        with np.load(CACHE_FILE, allow_pickle=False) as cache:
+            columns = { key: cache[key] for key in cache.files }
+        metadata = json.loads(str(columns.pop("metadata")))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if metadata["version"] != CACHE_VERSION or metadata["sources"].keys() != SOURCE_FILES.keys():
+        return None
+
+    # A source with the same size and modification time is trusted, otherwise its contents have to match
+    for name, (size, mtime_ns) in [(x[0], x[1:]) for x in get_source_signature()]:
+        source = metadata["sources"][name]
+        if (source["size"], source["mtime_ns"]) != (size, mtime_ns) and source["sha256"] != hash_file(SOURCE_FILES[name]):
+            return None
+
+    return columns
+
+def write_cache(columns: dict[str, np.ndarray]) -> None:
+    metadata = {
+        "version": CACHE_VERSION,
+        "sources": { name: { "size": size, "mtime_ns": mtime_ns, "sha256": hash_file(SOURCE_FILES[name]) } for name, size, mtime_ns in get_source_signature() }
+    }
+
+    # Written under a temporary name first, so parallel runs never read half a file
+    temporary_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(temporary_file, "wb") as file:
+            np.savez(file, metadata=np.array(json.dumps(metadata)), **columns)
+        os.replace(temporary_file, CACHE_FILE)
+    except OSError as error:
+        warnings.warn(f"Could not write the data cache {CACHE_FILE}: {error}")
 
-        self.opnames = pd.read_csv(opnames_full_path, delimiter=",")
-        self.opnames["date"] = pd.to_datetime(self.opnames["adm_icu"]).dt.day_of_year
-        self.opnames["hour"] = pd.to_datetime(self.opnames["adm_icu"]).dt.hour
-        self.opnames["year"] = pd.to_datetime(self.opnames["adm_icu"]).dt.year
 
+def read_exported_data(data_folder: str) -> tuple[tuple, dict[str, np.ndarray]]:
+    """Maps the columns written by DataManager.export_data read-only and returns them with the signature of their sources."""
+    with open(os.path.join(data_folder, "metadata.json")) as file:
+        metadata = json.load(file)
+
+    if metadata["version"] != CACHE_VERSION:
+        raise ValueError(f"{data_folder} was exported by another version of the DataManager")
+
+    signature = tuple(tuple(x) for x in metadata["signature"])
+    return signature, { name: np.load(os.path.join(data_folder, f"{name}.npy"), mmap_mode="r") for name in metadata["columns"] }
+
+
+class DataManager:
+    # Preprocessed data shared by every DataManager in this process, by the signature of the source files
+    shared = {}
+
+    def __init__(self, use_cache: bool = True, data_folder: str = None) -> None:
         self.OPTIONS = {
             "NEC": [12],
             "INT": [2, 4, 7, 41, 47],
@@ -123,50 +166,167 @@ class DataManager:
             "CAPU": [29, 50],
             "Other": [15, 18, 19, 20, 23, 36, 48, 98]
         }
-        self.opnames = self.opnames.dropna(subset=["los_icu"])
-        self.opnames = self.opnames[self.opnames["los_icu"] > 0]
-        self.opnames["ref_spec"] = self.opnames["ref_spec"].apply(lambda x: self.get_spec(x))
 
-        # Get two years of covid data 
-        covid_data_full_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "COVID-19_ic_opnames.csv"))
-        self.covid_data = pd.read_csv(covid_data_full_path, delimiter=";")
-        self.covid_data["Date_of_statistics"] = pd.to_datetime(self.covid_data["Date_of_statistics"])
+        if data_folder is not None:
+            # Attach to columns exported by another process, they are mapped read-only instead of copied
+            signature, columns = read_exported_data(data_folder)
+            shared = self.create_shared_data(columns)
+            DataManager.shared[signature] = shared
+        else:
+            signature = get_source_signature()
+            shared = DataManager.shared.get(signature) if use_cache else None
+            if shared is None:
+                shared = self.create_shared_data(self.load_columns(use_cache))
+                if use_cache:
+                    DataManager.shared[signature] = shared
+
+        # Shared between models, so these are never changed
+        self.columns: dict[str, np.ndarray] = shared["columns"]
+        self.opnames: pd.DataFrame = shared["opnames"]
+        self.covid_data: pd.DataFrame = shared["covid_data"]
+        self.daily_profile = shared["daily_profile"]
+        self.covid_admissions = shared["covid_admissions"]
+        # Scaled spike series by scale, see get_icu_spikes
+        self.icu_spikes = {}
+        self.mean_std_by_planned = shared["mean_std_by_planned"]
+        self.patient_sampler = shared["patient_sampler"]
+
+    @classmethod
+    def attach_data(cls, data_folder: str) -> None:
+        """Makes every DataManager of this process use the columns exported to data_folder, used as worker initializer."""
+        cls(data_folder=data_folder)
+
+    def export_data(self, data_folder: str) -> str:
+        """Writes the preprocessed columns as .npy files that other processes can map with attach_data."""
+        os.makedirs(data_folder, exist_ok=True)
+        for name, values in self.columns.items():
+            np.save(os.path.join(data_folder, f"{name}.npy"), values)
+
+        with open(os.path.join(data_folder, "metadata.json"), "w") as file:
+            json.dump({ "version": CACHE_VERSION, "signature": get_source_signature(), "columns": list(self.columns.keys()) }, file)
+
+        return data_folder
+
+    def create_shared_data(self, columns: dict[str, np.ndarray]) -> dict:
+        self.opnames, self.covid_data = self.create_dataframes(columns)
+
+        return {
+            "columns": columns,
+            "opnames": self.opnames,
+            "covid_data": self.covid_data,
+            "daily_profile": self.create_daily_profile(),
+            "covid_admissions": self.covid_data["IC_admission"].sort_index().to_numpy(),
+            "mean_std_by_planned": { planned: self.create_mean_std_by_planned(planned) for planned in [False, True] },
+            "patient_sampler": PatientSampler(columns["specs"], columns["spec_codes"], columns["age"], columns["gender"], columns["los_icu"])
+        }
 
-        mask = (self.covid_data['Date_of_statistics'] > self.covid_data['Date_of_statistics'][0]) & (self.covid_data['Date_of_statistics'] <= self.covid_data['Date_of_statistics'][730])
+    def load_columns(self, use_cache: bool = True) -> dict[str, np.ndarray]:
+        """Reads the preprocessed data from the on-disk cache, the csv files are only parsed when they changed since it was written."""
+        columns = read_cache() if use_cache else None
+        if columns is None:
+            columns = self.preprocess_data()
+            if use_cache:
+                write_cache(columns)
+
+        return columns
+
+    def create_dataframes(self, columns: dict[str, np.ndarray]) -> tuple[pd.DataFrame, pd.DataFrame]:
+        # copy=False keeps the numeric columns as views, so mapped columns stay shared
+        opnames = pd.DataFrame({
+            "ref_spec": pd.Categorical.from_codes(columns["spec_codes"], categories=columns["specs"]),
+            "los_icu": columns["los_icu"],
+            "age": columns["age"],
+            "gender": columns["gender"],
+            "plan_adm": columns["plan_adm"],
+            "date": columns["date"],
+            "hour": columns["hour"],
+            "year": columns["year"]
+        }, copy=False)
+        covid_data = pd.DataFrame({
+            "Date_of_statistics": columns["covid_dates"],
+            "IC_admission": columns["covid_ic_admission"]
+        }, index=columns["covid_index"], copy=False)
+
+        return opnames, covid_data
+
+    def preprocess_data(self) -> dict[str, np.ndarray]:
+        """Parses and cleans the source csv files into typed columns."""
+        opnames = pd.read_csv(SOURCE_FILES["opnames"], delimiter=",")
+        adm_icu = pd.to_datetime(opnames["adm_icu"])
+        opnames["date"] = adm_icu.dt.day_of_year
+        opnames["hour"] = adm_icu.dt.hour
+        opnames["year"] = adm_icu.dt.year
+
+        opnames = opnames.dropna(subset=["los_icu"])
+        opnames = opnames[opnames["los_icu"] > 0]
+        # Every distinct code only has to be mapped once
+        opnames["ref_spec"] = opnames["ref_spec"].map({ x: self.get_spec(x) for x in opnames["ref_spec"].unique() })
+        specs, spec_codes = np.unique(opnames["ref_spec"].to_numpy(dtype=str), return_inverse=True)
+
+        # Rows are grouped by spec, keeping their order within a spec, so the patient sampler can use slices of the columns
+        order = np.argsort(spec_codes, kind="stable")
+        opnames = opnames.iloc[order]
+        spec_codes = spec_codes[order]
 
-        self.covid_data: pd.DataFrame = self.covid_data.loc[mask]
+        # Get two years of covid data 
+        covid_data = pd.read_csv(SOURCE_FILES["covid_data"], delimiter=";")
+        covid_data["Date_of_statistics"] = pd.to_datetime(covid_data["Date_of_statistics"])
+
+        mask = (covid_data['Date_of_statistics'] > covid_data['Date_of_statistics'][0]) & (covid_data['Date_of_statistics'] <= covid_data['Date_of_statistics'][730])
+
+        covid_data = covid_data.loc[mask]
+
+        return {
+            "specs": specs,
+            "spec_codes": spec_codes.astype(np.int8),
+            "los_icu": opnames["los_icu"].to_numpy(dtype=np.float64),
+            "age": opnames["age"].to_numpy(dtype=np.int64),
+            "gender": opnames["gender"].to_numpy(dtype=str),
+            "plan_adm": opnames["plan_adm"].to_numpy(dtype=np.float64),
+            "date": opnames["date"].to_numpy(dtype=np.int32),
+            "hour": opnames["hour"].to_numpy(dtype=np.int32),
+            "year": opnames["year"].to_numpy(dtype=np.int32),
+            "covid_index": covid_data.index.to_numpy(dtype=np.int64),
+            "covid_dates": covid_data["Date_of_statistics"].to_numpy(dtype="datetime64[ns]"),
+            "covid_ic_admission": covid_data["IC_admission"].to_numpy(dtype=np.int64)
+        }
 
-    def get_amount_percentage_by_day(self, day: int = 1, planned: bool = False) -> float:
+    def create_daily_profile(self) -> np.ndarray:
+        """
+            Builds a (366, 2) table with the average share of a year's admissions that arrives on each day of the year.
+            Rows are indexed by day - 1, column 0 holds unplanned and column 1 planned admissions.
+        """
         opnames = self.opnames[self.opnames["year"] != 2014]
+        all_year_totals = opnames.groupby("year").size()
 
-        all_day_of_year_grouped_opnames = opnames.groupby(["year", "date"])
-        all_year_totals = all_day_of_year_grouped_opnames.size().groupby(level=0).sum()
-
-        opnames = opnames[opnames["plan_adm"] == (planned)]
+        profile = np.zeros((366, 2))
+        for column, planned in enumerate([False, True]):
+            planned_opnames = opnames[opnames["plan_adm"] == planned]
+            day_counts = planned_opnames.groupby(["year", "date"]).size()
 
+            percentages = day_counts / all_year_totals.reindex(day_counts.index.get_level_values("year")).values
+            percentages_sum = percentages.groupby(level="date").sum() / planned_opnames["year"].nunique()
 
-        day_of_year_grouped_opnames = opnames.groupby(["year", "date"])
+            profile[percentages_sum.index.values - 1, column] = percentages_sum.values
 
-        percentages = day_of_year_grouped_opnames.size() / all_year_totals
+        return profile
 
-        groups = np.sort(list(set([x[0] for x in percentages.keys()])))
-        percentages_sum = None
-        for group in groups:
-            if(type(percentages_sum) == type(None)):
-                percentages_sum = percentages.get(group)
-            else:
-                percentages_sum = percentages_sum.add(percentages.get(group), axis=0, level=0, fill_value=0)
-            
-            
+    def get_amount_percentage_by_day(self, day: int = 1, planned: bool = False) -> float:
+        if day < 1 or day > len(self.daily_profile):
+            return 0
 
+        return self.daily_profile[day - 1, int(planned)]
 
-        percentages_sum = percentages_sum / len(groups)
-        
-        return percentages_sum[day] if day in percentages_sum else 0
+    def get_amount_percentages(self, planned: bool = False) -> np.ndarray:
+        """Returns the share of the yearly admissions for every day of the year, index 0 being the first of January."""
+        return self.daily_profile[:, int(planned)]
     
-    def get_mean_std_by_planned(self, planned: bool = False) -> tuple[float, float]:
+    def create_mean_std_by_planned(self, planned: bool = False) -> tuple[float, float]:
         filtered_opnames = self.opnames[self.opnames["plan_adm"] == int(planned)]["hour"]
         return (np.std(filtered_opnames) * 3600, np.mean(filtered_opnames) * 3600)
+
+    def get_mean_std_by_planned(self, planned: bool = False) -> tuple[float, float]:
+        return self.mean_std_by_planned[bool(planned)]
     
     def get_spec(self, x):
         """Maps a numerical or string ref_spec value to its specialty group."""
@@ -179,55 +339,94 @@ class DataManager:
                 return option
 
     def create_patients(self, size: int = 1) -> np.array:
-        # opnames_df = pd.read_csv("opnames.csv", delimiter=",")
-        # opnames_df["ref_spec"] = opnames_df["ref_spec"].apply(lambda x: self.get_spec(x))
-        # opnames_df_dropped = opnames_df.dropna(subset=["los_icu"])
+        patients = self.patient_sampler.sample(size)
 
-        patients = []
-        spec_unique, spec_counts = np.unique(self.opnames["ref_spec"], return_counts=True)
-        spec_probabilities = spec_counts / spec_counts.sum()
-        patient_specs = np.random.choice(spec_unique, p=spec_probabilities, size=size)
-        for spec in patient_specs:
-            spec_group = self.opnames[self.opnames["ref_spec"] == spec]
+        return np.array([{ key: values[i] for key, values in patients.items() } for i in range(size)])
+    
+    def get_icu_spikes(self, scale: float = ICU_SPIKE_SCALE) -> np.ndarray:
+        """
+            The covid IC admissions of the AMC for every day of the covid data, index 0 being its first day. The series is
+            scaled once per scale, scale being the share of the national admissions that go to the hospital.
+        """
+        #https://www.eerstekamer.nl/overig/20230914/interactieve_tijdlijn_ic_3/document#:~:text=Eerst%20worden%20er%20vooral%20regionale,vanaf%2013%20oktober%202020%20noodzakelijk.&text=De%20IC%2Dcapaciteit%20is%20sinds,te%20hoog%20en%20te%20lang.
+        if scale not in self.icu_spikes:
+            self.icu_spikes[scale] = np.maximum((scale * self.covid_admissions).astype(np.int64), 0)
 
-            # Age distribution
-            age_unique, age_counts = np.unique(spec_group["age"], return_counts=True)
-            age_probabilities = age_counts / age_counts.sum()
-            patient_age = np.random.choice(age_unique, p=age_probabilities)
+        return self.icu_spikes[scale]
 
-            # Gender distribution
-            M_count = len(spec_group[spec_group["gender"] == "M"])
-            F_count = len(spec_group[spec_group["gender"] == "F"])
-            total_gender = M_count + F_count
-            gender_probabilities = [M_count / total_gender, F_count / total_gender]
-            patient_gender = np.random.choice(["M", "F"], p=gender_probabilities)
+    def get_icu_spike_counts(self, first_day: int, days: int, scale: float = ICU_SPIKE_SCALE) -> np.ndarray:
+        """The spike admissions of days first_day up to first_day + days, the covid data repeats after its last day."""
+        spikes = self.get_icu_spikes(scale)
+        return spikes[(np.arange(first_day, first_day + days) - 1) % len(spikes)]
 
-            # ICU length of stay
-            los_icu_values = spec_group["los_icu"].values
-            patient_los_icu = np.random.choice(los_icu_values)
+    def get_icu_spike_by_day(self, day: int, scale: float = ICU_SPIKE_SCALE) -> int:
+        spikes = self.get_icu_spikes(scale)
+        return int(spikes[(day - 1) % len(spikes)])
 
-            patients.append({
-                "ref_spec": spec,
-                "age": patient_age,
-                "gender": patient_gender,
-                "los_icu": patient_los_icu
-            })
 
-        return np.array(patients)
-    
-    def get_icu_spike_by_day(self, day: int):
-        #https://www.eerstekamer.nl/overig/20230914/interactieve_tijdlijn_ic_3/document#:~:text=Eerst%20worden%20er%20vooral%20regionale,vanaf%2013%20oktober%202020%20noodzakelijk.&text=De%20IC%2Dcapaciteit%20is%20sinds,te%20hoog%20en%20te%20lang.
+class PatientSampler:
+    """
+        Precomputes the spec, age, gender and length of stay distributions of the admissions data per spec,
+        so that any amount of patients can be drawn with a handful of vectorized numpy calls.
+        The lengths of stay are kept as slices of the given column, which can be a read-only memory map.
+    """
+    def __init__(self, specs: np.ndarray, spec_codes: np.ndarray, ages: np.ndarray, genders: np.ndarray, los_icu: np.ndarray) -> None:
+        if np.any(np.diff(spec_codes) < 0):
+            order = np.argsort(spec_codes, kind="stable")
+            spec_codes, ages, genders, los_icu = spec_codes[order], ages[order], genders[order], los_icu[order]
 
-        if (day > len(self.covid_data)):
-            day = day - ((day % len(self.covid_data)) * len(self.covid_data))
-        
-        admissions = self.covid_data["IC_admission"][day]
-
-        # The amount admissions currently is, is all the IC admissions across the netherlands. To get an estimate of the amount that would have been admitted to AMC we do the following:
-        # There were a total of 1150 IC beds, when covid hit this was upscaled to 1350. AMC has around 32 IC beds generally if use the growth and apply it percentage wise
-        # to the 32 we should get an estimate of how many beds there were
-        amount_of_beds = int(1350 * (32 / 1150))
-        percentage_of_admissions = amount_of_beds / 1350
-        admissions = int(percentage_of_admissions * admissions)
-        
-        return admissions if admissions >= 0 else 0
+        self.specs = np.asarray(specs)
+        spec_counts = np.bincount(spec_codes, minlength=len(self.specs))
+        self.spec_cdf = np.cumsum(spec_counts / spec_counts.sum())
+        offsets = np.concatenate(([0], np.cumsum(spec_counts)))
+
+        self.ages = []
+        self.age_cdfs = []
+        self.male_probabilities = np.zeros(len(self.specs))
+        self.los_values = []
+
+        for i in range(len(self.specs)):
+            spec_group = slice(offsets[i], offsets[i + 1])
+
+            # Age distribution
+            age_unique, age_counts = np.unique(ages[spec_group], return_counts=True)
+            self.ages.append(age_unique)
+            self.age_cdfs.append(np.cumsum(age_counts / age_counts.sum()))
+
+            # Gender distribution
+            M_count = (genders[spec_group] == "M").sum()
+            F_count = (genders[spec_group] == "F").sum()
+            self.male_probabilities[i] = M_count / (M_count + F_count)
+
+            # ICU length of stay
+            self.los_values.append(los_icu[spec_group])
+
+    @staticmethod
+    def draw_categories(cdf: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        return np.minimum(np.searchsorted(cdf, uniforms, side="right"), len(cdf) - 1)
+
+    def sample(self, size: int = 1, random = np.random, los_random = None) -> dict[str, np.ndarray]:
+        """
+            Draws the spec, age and gender from random and the length of stay from los_random, both default to numpy's
+            global random state. The amount of draws only depends on size, so a stream always gives the same patients.
+        """
+        los_random = los_random if los_random is not None else random
+        spec_codes = self.draw_categories(self.spec_cdf, random.random(size))
+
+        ages = np.zeros(size, dtype=int)
+        los_icu = np.zeros(size)
+        for i in np.unique(spec_codes):
+            mask = spec_codes == i
+            count = mask.sum()
+
+            ages[mask] = self.ages[i][self.draw_categories(self.age_cdfs[i], random.random(count))]
+            los_icu[mask] = self.los_values[i][(los_random.random(count) * len(self.los_values[i])).astype(int)]
+
+        genders = np.where(random.random(size) < self.male_probabilities[spec_codes], "M", "F")
+
+        return {
+            "ref_spec": self.specs[spec_codes],
+            "age": ages,
+            "gender": genders,
+            "los_icu": los_icu
+        }
@@ -0,0 +1,147 @@
+import argparse
+from batch_run import create_model, create_pool, create_seeds
+from lib.optimization import CapacityOptimizer, Candidate, get_pareto_front
+from lib.replication import calculate_kpis
+import numpy as np
+import os
+import json
+
+def run_candidate(task: dict) -> dict[str, float]:
+    """The KPIs of one replication of a candidate, with the share of the arriving patients that was refused."""
+    model = create_model({ **task["params"], "capacity": task["capacity"], "distribution": task["distribution"] }, seed=task["seed"], event_driven=task["event_driven"])
+    model.run_for_days(task["time"])
+
+    kpis = calculate_kpis(model)
+    arrivals = model.datacollector.get_table_columns("amount")["admissions"].sum()
+    kpis["refusal_rate"] = kpis["refused"] / arrivals if arrivals > 0 else 0.0
+    return kpis
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Search the smallest capacity and best split of the beds that keeps refusals below a target.")
+
+    parser.add_argument(
+        "--time",
+        type=int,
+        required=True,
+        help="Specify the time in days of every run, e.g: 365."
+    )
+
+    parser.add_argument(
+        "--target",
+        type=float,
+        required=True,
+        help="Highest allowed fraction of the arriving patients that is refused, e.g: 0.02."
+    )
+
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="./batch_run_config.json",
+        help="Path to the json file with the parameter sets, the other parameters and the starting split come from it."
+    )
+
+    parser.add_argument(
+        "--params",
+        type=int,
+        default=0,
+        help="Index of the parameter set in the config to optimize."
+    )
+
+    parser.add_argument("--min-capacity", type=int, default=None, help="Smallest capacity to consider, defaults to one bed per department group.")
+    parser.add_argument("--max-capacity", type=int, default=None, help="Largest capacity to consider, defaults to twice the capacity of the parameter set.")
+
+    parser.add_argument(
+        "--replications",
+        type=int,
+        default=10,
+        help="Highest amount of seeded runs per candidate, every candidate runs the same seeds."
+    )
+
+    parser.add_argument(
+        "--min-replications",
+        type=int,
+        default=3,
+        help="Amount of runs a candidate needs before it can be stopped early."
+    )
+
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the intervals used to stop candidates early."
+    )
+
+    parser.add_argument(
+        "--max-iterations",
+        type=int,
+        default=20,
+        help="Highest amount of moves of the search over splits."
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Amount of worker processes, 1 runs everything in this process."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed from which the seeds of all runs are derived, a random one is picked when omitted."
+    )
+
+    parser.add_argument(
+        "--event-driven",
+        action="store_true",
+        help="Run the models with the discrete event engine instead of stepping every agent each clock tick."
+    )
+
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        params = json.load(file)[args.params]
+
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % (2**32))
+    seeds = [int(x) for x in create_seeds(seed, 1, args.replications)[0]]
+
+    groups = len(params["departments"])
+    distribution = params["distribution"] if len(params["distribution"]) == groups else [1 / groups] * groups
+    low = args.min_capacity if args.min_capacity is not None else groups
+    high = args.max_capacity if args.max_capacity is not None else 2 * params["capacity"]
+
+    if not os.path.exists("./runs"):
+        os.mkdir("./runs")
+
+    run_folder = f"./runs/run{len(os.listdir('./runs'))}"
+    os.mkdir(run_folder)
+    print(f"Optimizing parameter set {args.params} between {low} and {high} beds with seed {seed} in {run_folder}")
+
+    def create_task(candidate: Candidate, seed: int) -> dict:
+        return {
+            "params": params,
+            "capacity": candidate.capacity,
+            "distribution": candidate.distribution,
+            "seed": seed,
+            "time": args.time,
+            "event_driven": args.event_driven
+        }
+
+    if args.workers <= 1:
+        optimizer = CapacityOptimizer(lambda runs: [run_candidate(create_task(*x)) for x in runs], seeds, args.target, args.confidence, args.min_replications)
+        result = optimizer.optimize(low, high, distribution, args.max_iterations)
+    else:
+        with create_pool(args.workers) as executor:
+            optimizer = CapacityOptimizer(lambda runs: list(executor.map(run_candidate, [create_task(*x) for x in runs])), seeds, args.target, args.confidence, args.min_replications)
+            result = optimizer.optimize(low, high, distribution, args.max_iterations)
+
+    candidates = optimizer.get_candidates_dataframe()
+    candidates.to_csv(f"{run_folder}/candidates.csv", sep=";", index=False)
+    get_pareto_front(candidates).to_csv(f"{run_folder}/pareto.csv", sep=";", index=False)
+
+    with open(f"{run_folder}/optimum.json", "w") as file:
+        json.dump({ **result, "target": args.target, "seed": seed, "params": args.params }, file, indent=2)
+
+    print(f"Capacity {result['capacity']} split as {result['beds']}" + ("" if result["feasible"] else f", which doesn't meet the target of {args.target}"))
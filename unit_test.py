@@ -1,11 +1,23 @@
 import unittest
+import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
+import solara
 from unittest.mock import patch
 from lib.model import ICUModel
 from lib.agents import Patient, Frontdesk, Department, Home
-from lib.utils import Clock, DataManager
+from lib.utils import Clock, DataManager, SOURCE_FILES, read_cache, write_cache
+from lib.replication import RunningStatistics, ReplicationAggregator
+from lib.datacollection import ColumnarDataCollector
+from lib.results import export_tables, save_results, load_results
+from lib.schedule import ArrivalSchedule
+from lib.snapshot import save_snapshot, load_snapshot
+from lib.patient_store import PatientStore, ADMITTED_CODE
 from unittest.mock import MagicMock
+from benchmark import create_matrix, compare_results
+from lib.optimization import CapacityOptimizer, beds_to_distribution, get_pareto_front
 
 class TestICUModel(unittest.TestCase):
     def setUp(self):
@@ -38,6 +50,65 @@ class TestICUModel(unittest.TestCase):
         patient.set_icu_department(department)
         self.assertEqual(patient.icu_department, department)
 
+    def test_department_bed_store(self):
+        # Test if beds are handed out per bed type and the free count is kept up to date
+        self.model.pandemic_allocation_percentage = 0.5
+        department = Department(self.model, specs=["CARD"], capacity=4)
+        normal_patients = [Patient(self.model, age=50, gender="M", planned=False, spec="CARD", los_icu=1) for _ in range(2)]
+        pandemic_patient = Patient(self.model, age=50, gender="M", planned=False, spec="CARD", los_icu=1, bed_type="pandemic")
+
+        for patient in normal_patients:
+            department.allocate_patient_location(patient)
+        self.assertFalse(department.has_free_bed(normal_patients[0]), "Normal patients can't use pandemic beds.")
+        self.assertTrue(department.has_free_bed(pandemic_patient))
+        self.assertEqual(department.current_capacity, 2)
+
+        department.allocate_patient_location(pandemic_patient)
+        self.assertEqual(department.bed_types[department.patient_beds[pandemic_patient.unique_id]], 1)
+
+        department.free_capacity(normal_patients[0])
+        self.assertTrue(department.has_free_bed(normal_patients[1]))
+        self.assertEqual(department.current_capacity, 2)
+
+    def test_discharge_heap(self):
+        # Test if the moment of discharge is set at admission and only due patients are discharged, specialized stays are shorter
+        department = Department(self.model, specs=["CARD"], capacity=4, is_specialized=True)
+        self.model.efficiency = 1
+        patients = [Patient(self.model, age=50, gender="M", planned=False, spec="CARD", los_icu=los) for los in [2, 1, 1]]
+        for patient in patients:
+            self.model.space.place_agent(patient, (0, 0))
+            patient.set_icu_department(department)
+            department.allocate_patient_location(patient)
+            patient.admit()
+        self.assertNotIn(patients[0], self.model.patients_in_transit)
+        self.assertEqual([x.discharge_at for x in patients], [24 * 3600 - 600, 12 * 3600 - 600, 12 * 3600 - 600])
+
+        self.model.clock.advance(patients[1].discharge_at)
+        department.discharge_due_patients()
+        self.assertEqual([x[2] for x in department.discharges], [patients[0]])
+        self.assertEqual(department.current_capacity, 3)
+        admissions = self.model.datacollector.get_table_dataframe("admissions")
+        self.assertEqual(list(admissions["los_icu"]), [1, 1])
+
+    def test_department_routing(self):
+        # Test if every spec is routed through the index and configuration problems are reported
+        departments = solara.reactive([["CAPU", "CARD", "INT", "Other", "CHIR", "NEC", "NEU"]])
+        model = ICUModel(seed=1, size=10, amount=100, departments=departments)
+        department = model.agents_by_type[Department][0]
+        for spec in departments.value[0]:
+            self.assertIs(model.get_icu_department(spec), department)
+        self.assertEqual(model.routing_report, { "unmapped": [], "duplicated": {} })
+
+        # A running model keeps routing to its departments, the changed reactive is for the next model
+        departments.value = [["CAPU", "CARD"]]
+        self.assertIs(model.get_icu_department("NEU"), department)
+        self.assertEqual(sum([len(x) for x in departments.listeners.values()]), 0)
+
+        with self.assertWarns(UserWarning):
+            model = ICUModel(seed=1, size=10, amount=100, departments=solara.reactive([["CAPU", "INT", "NEU", "Other", "CHIR", "NEC"], ["CARD", "CAPU"]]), distribution=solara.reactive([0.5, 0.5]))
+        self.assertIs(model.get_icu_department("CAPU"), model.agents_by_type[Department][1])
+        self.assertEqual(list(model.routing_report["duplicated"].keys()), ["CAPU"])
+
     def test_normal_distribution(self):
         # Test if generated timestamps follow a normal distribution and are within valid bounds
         timestamps = self.model.get_normally_distributed_timestamps(size=100)
@@ -46,6 +117,39 @@ class TestICUModel(unittest.TestCase):
         self.assertGreater(mean, 0)
         self.assertLessEqual(max(timestamps), 24 * 3600)
 
+    def test_daily_profile(self):
+        # Test if the precomputed daily profile serves the same values as the per day lookup
+        datamanager = self.model.datamanager
+        self.assertEqual(datamanager.daily_profile.shape, (366, 2))
+        for planned in [False, True]:
+            percentages = datamanager.get_amount_percentages(planned)
+            self.assertEqual(datamanager.get_amount_percentage_by_day(1, planned), percentages[0])
+            self.assertEqual(datamanager.get_amount_percentage_by_day(200, planned), percentages[199])
+        self.assertEqual(datamanager.get_amount_percentage_by_day(367, True), 0)
+
+    def test_icu_spike(self):
+        # Test if the spike series repeats after the covid data ends, scales as given and fills the schedules of later years
+        datamanager = self.model.datamanager
+        days = len(datamanager.get_icu_spikes())
+        self.assertEqual(datamanager.get_icu_spike_by_day(days + 5), datamanager.get_icu_spike_by_day(5))
+        self.assertEqual(datamanager.get_icu_spike_by_day(3 * days + 5), datamanager.get_icu_spike_by_day(5))
+        np.testing.assert_array_equal(datamanager.get_icu_spike_counts(days - 1, 3), [datamanager.get_icu_spike_by_day(x) for x in [days - 1, days, 1]])
+        self.assertGreater(datamanager.get_icu_spikes(1).sum(), datamanager.get_icu_spikes().sum())
+
+        model = ICUModel(seed=1, amount=100, use_ic_spike=True, ic_spike_scale=0.1, headless=True)
+        model.clock.advance(3 * 365 * model.clock.seconds_in_day)
+        model.create_agent_schedules()
+        expected = datamanager.get_icu_spike_counts(model.clock.days + 1, model.clock.days_in_year, 0.1)
+        np.testing.assert_array_equal([model.unplanned_schedules.values[i].sum() for i in range(model.clock.days_in_year)], expected)
+
+    def test_patient_sampler(self):
+        # Test if the batch sampler draws complete patients from the known specs
+        patients = self.model.datamanager.patient_sampler.sample(50)
+        for key in ["ref_spec", "age", "gender", "los_icu"]:
+            self.assertEqual(len(patients[key]), 50)
+        self.assertTrue(set(patients["ref_spec"]) <= set(self.model.datamanager.OPTIONS.keys()))
+        self.assertTrue(all(patients["los_icu"] > 0))
+
     def test_data_collection(self):
         # Test if the data collector properly tracks admissions and metrics
         self.model.datacollector.collect(self.model)
@@ -59,26 +163,192 @@ class TestICUModel(unittest.TestCase):
         # Test if the correct number of agents is created and placed in the environment
         self.model.agent_schedules[1] = [1, 2, 3, 4]
         self.model.step()
-        self.assertEqual(len(self.model.space.agents), 4, "Four patients should be created.")
+        self.assertEqual(len([x for x in self.model.agents_by_type[Patient] if x.planned]), 4, "Four patients should be created.")
 
         # Verify creation of key agents like Departments, Frontdesk, and Home
         self.assertTrue(len(self.model.agents_by_type[Department]) > 0, "Departments should be created.")
         self.assertEqual(len(self.model.agents_by_type[Frontdesk]), 1, "There should be one Frontdesk agent.")
         self.assertEqual(len(self.model.agents_by_type[Home]), 1, "There should be one Home agent.")
 
+    def test_headless_run(self):
+        # Test if a headless run skips the grid but produces the same tables as a run with the grid
+        models = []
+        for headless in [False, True]:
+            models.append(ICUModel(seed=1, size=10, amount=2200, clock_speed=10, capacity=5, headless=headless))
+            models[-1].run_for_days(2)
+        self.assertIsNone(models[1].space)
+
+        for table in ["admissions", "refused", "costs", "waiting"]:
+            pd.testing.assert_frame_equal(models[0].datacollector.get_table_dataframe(table), models[1].datacollector.get_table_dataframe(table))
+        states = { patient.state for patient in models[1].agents_by_type[Patient] }
+        self.assertTrue(states <= { "waiting", "at_desk", "at_department", "admitted" })
+
+    def test_patient_store(self):
+        # Test if patients kept in the NumPy store give the same tables as patient agents, in both modes and with reused slots
+        for event_driven in [False, True]:
+            models = [ICUModel(seed=1, amount=4500, clock_speed=10, capacity=5, planning_method=2, headless=True, event_driven=event_driven, patient_store=store) for store in [False, True]]
+            models[1].patient_store = PatientStore(models[1], size=4)
+            for model in models:
+                model.run_for_days(3)
+
+            for table in ["admissions", "refused", "replanning", "waiting", "costs"]:
+                pd.testing.assert_frame_equal(models[0].datacollector.get_table_dataframe(table), models[1].datacollector.get_table_dataframe(table))
+            store = models[1].patient_store
+            self.assertEqual([(x.spec, x.state) for x in models[0].get_patients()], [(x.spec, x.state) for x in store.get_patients()])
+            self.assertGreater(store.size, 4)
+            self.assertGreater(store.next_id - 1, store.end, "Slots of patients that left are reused.")
+            self.assertEqual(store.in_transit, np.count_nonzero(store.columns["state"][:store.end] < ADMITTED_CODE))
+
+        with self.assertRaises(ValueError):
+            ICUModel(seed=1, patient_store=True)
+
+    def test_profiled_run(self):
+        # Test if profiling times every phase and agent type without changing the outcome of the run
+        models = []
+        for profile in [False, True]:
+            models.append(ICUModel(seed=1, size=10, amount=2200, clock_speed=10, capacity=5, profile=profile))
+            models[-1].run_for_days(1)
+        pd.testing.assert_frame_equal(models[0].datacollector.get_table_dataframe("admissions"), models[1].datacollector.get_table_dataframe("admissions"))
+        self.assertRaises(ValueError, models[0].get_profile_dataframe)
+
+        profile = models[1].get_profile_dataframe().set_index(["category", "name"])
+        self.assertEqual(profile.loc[("phase", "collect"), "calls"], 24 * 6)
+        self.assertEqual(profile.loc[("agent", "Frontdesk"), "calls"], 24 * 6)
+        self.assertEqual(set(profile.loc["agent"].index), { "Patient", "Department", "Frontdesk", "Home" })
+        self.assertAlmostEqual(profile.loc["phase", "share"].sum(), 1)
+
+    def test_common_random_numbers(self):
+        # Test if models with the same seed draw the same arrivals and patients whatever their capacity and planning method
+        first = ICUModel(seed=7, amount=2200, capacity=5, planning_method=1, headless=True)
+        np.random.random(100)
+        second = ICUModel(seed=7, amount=2200, capacity=40, planning_method=2, headless=True)
+        with_spike = ICUModel(seed=7, amount=2200, use_ic_spike=True, headless=True)
+
+        for year in range(2):
+            if year == 1:
+                # The schedules of the next year are drawn after the spike arrivals of the first one
+                for model in [first, second, with_spike]:
+                    model.clock.advance(365 * 24 * 3600)
+                    model.start_year()
+            for day in [1, 100, 365]:
+                np.testing.assert_array_equal(first.agent_schedules[day], second.agent_schedules[day])
+                np.testing.assert_array_equal(first.unplanned_schedules[day], second.unplanned_schedules[day])
+                # The regular arrivals don't move when the spike arrivals are added
+                pandemic = with_spike.unplanned_schedules.values[day - 1]
+                np.testing.assert_array_equal(first.unplanned_schedules[day], with_spike.unplanned_schedules[day][~pandemic])
+            for _ in range(300):
+                data = first.next_patient_data()
+                self.assertEqual(data, second.next_patient_data())
+                # Neither do the regular patients when spike patients are drawn in between
+                with_spike.next_patient_data(True)
+                self.assertEqual(data, with_spike.next_patient_data())
+
+    def test_snapshot(self):
+        # Test if a model restored from a snapshot continues exactly like the model the snapshot was taken from
+        full = ICUModel(seed=3, amount=4500, clock_speed=10, capacity=10, planning_method=3, headless=True)
+        full.run_for_days(6)
+        warm = ICUModel(seed=3, amount=4500, clock_speed=10, capacity=10, planning_method=3, headless=True)
+        warm.run_for_days(3)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "snapshot.npz")
+            save_snapshot(path, warm.create_snapshot())
+            snapshot = load_snapshot(path)
+
+        for event_driven in [False, True]:
+            restored = ICUModel.from_snapshot(snapshot, event_driven=event_driven)
+            restored.run_for_days(3)
+            for table in ["admissions", "refused", "replanning", "waiting"]:
+                expected = full.datacollector.get_table_dataframe(table).iloc[restored.table_offsets[table]:].reset_index(drop=True)
+                pd.testing.assert_frame_equal(expected, restored.datacollector.get_table_dataframe(table))
+
+        # Parameters can change from the snapshot on, as long as the department groups stay the same
+        branched = ICUModel.from_snapshot(snapshot, planning_method=1, capacity=20)
+        self.assertEqual(branched.get_front_desk().planning_method, 1)
+        self.assertEqual(branched.clock.elapsed, 3 * 24 * 3600)
+        self.assertRaises(ValueError, ICUModel.from_snapshot, snapshot, departments=[["CAPU", "CARD"], ["INT", "Other", "CHIR", "NEC", "NEU"]])
+
+    def test_event_driven_run(self):
+        # Test if the event driven engine fills the same tables as the stepped model, also when the clock steps don't fit in an hour
+        for clock_speed in [10, 7]:
+            stepped = ICUModel(seed=1, size=10, amount=2200, clock_speed=clock_speed, capacity=5)
+            stepped.run_for_days(3)
+            model = ICUModel(seed=1, size=10, amount=2200, clock_speed=clock_speed, capacity=5, event_driven=True)
+            model.run_for_days(3)
+
+            self.assertEqual(model.clock.elapsed, stepped.clock.elapsed)
+            self.assertEqual(model.steps, stepped.steps)
+            for table in ["admissions", "refused", "costs", "capacity", "amount", "replanning", "waiting"]:
+                pd.testing.assert_frame_equal(model.datacollector.get_table_dataframe(table), stepped.datacollector.get_table_dataframe(table))
+        self.assertEqual(model.clock.get_time(True), "2025/01/03 23:59:00")
+
+    def test_reschedule_same_patient(self):
+        # Test if a replanned patient comes back on its new day with its own attributes
+        patient = self.model.create_agent(True)
+        data = patient.get_data()
+        day = self.model.get_front_desk().reschedule_patient_24(patient)
+        self.assertEqual(self.model.agent_schedules.count(day), len(self.model.agent_schedules[day]))
+
+        home = self.model.agents_by_type[Home][0]
+        home.current_day = day
+        self.model.clock.advance(24 * 3600)
+        replanned = [x for x in home.release_arrivals() if x.planned and x.age == data["age"] and x.spec == data["ref_spec"] and x.backup_los_icu == data["los_icu"]]
+        self.assertGreaterEqual(len(replanned), 1)
+
+    def test_replanning_into_next_year(self):
+        # Test if a patient replanned past the end of the year comes back on the first day of the next year
+        self.model.clock.advance(364 * 24 * 3600 + 23 * 3600)
+        patient = self.model.create_agent(True)
+        data = patient.get_data()
+        frontdesk = self.model.get_front_desk()
+        self.assertEqual(frontdesk.reschedule_patient_24(patient), 366)
+        self.assertEqual(self.model.agent_schedules.count(1), int(100 * self.model.datamanager.get_amount_percentage_by_day(1, True)))
+        self.assertEqual(frontdesk.count_planned_arrivals(366), self.model.agent_schedules.count(1) + 1)
+
+        # The first step of the year switches to the new schedules before anything else happens
+        self.model.clock.advance(3600 - self.model.clock.clock_speed)
+        self.model.step()
+        self.assertEqual(self.model.clock.get_time(True), "2026/01/01 00:00:00")
+        self.assertIn(data, [x[2] for x in self.model.agent_schedules.inserted[0]])
+        self.assertEqual(self.model.next_agent_schedules.count(1), 0)
+
+    def test_frontdesk_queue(self):
+        # Test if the priority queue helps unplanned patients first, service_rate at a time, and records the waiting time
+        frontdesk = self.model.get_front_desk()
+        frontdesk.queue_discipline = "priority"
+        frontdesk.service_rate = 2
+        patients = [self.model.create_agent(planned) for planned in [True, False, True]]
+        for patient in patients:
+            frontdesk.enqueue(patient)
+        self.assertEqual(self.model.datacollector.model_reporters["Queue length"](self.model), 3)
+
+        self.model.clock.advance(600)
+        frontdesk.serve()
+        waiting = self.model.datacollector.get_table_dataframe("waiting")
+        self.assertEqual(list(waiting["plan_adm"]), [False, True])
+        self.assertTrue(all(waiting["wait_time"] == 600))
+        self.assertEqual(len(frontdesk.queue), 1)
+
 class TestDataManager(unittest.TestCase):
     @patch("lib.utils.pd.read_csv")
     def setUp(self, mock_read_csv):
-        # Mock CSV read to avoid dependency on an actual file
-        mock_read_csv.return_value = pd.DataFrame({
-            "adm_icu": ["2025-01-01 08:00:00", "2025-01-01 10:00:00", "2025-01-01 12:00:00"],
-            "plan_adm": [1, 1, 0],  # Variation: 1, 1, 0
-            "los_icu": [10, 20, 30],
-            "ref_spec": ["CARD", "NEU", "CARD"],
-            "age": [30, 60, 50],
-            "gender": ["M", "F", "M"]
-        })
-        self.data_manager = DataManager()
+        # Mock both CSV reads to avoid dependency on the actual files, the caches are skipped so the mocks are read
+        data = {
+            SOURCE_FILES["opnames"]: pd.DataFrame({
+                "adm_icu": ["2025-01-01 08:00:00", "2025-01-01 10:00:00", "2025-01-01 12:00:00"],
+                "plan_adm": [1, 1, 0],  # Variation: 1, 1, 0
+                "los_icu": [10, 20, 30],
+                "ref_spec": ["CARD", "NEU", "CARD"],
+                "age": [30, 60, 50],
+                "gender": ["M", "F", "M"]
+            }),
+            SOURCE_FILES["covid_data"]: pd.DataFrame({
+                "Date_of_statistics": pd.date_range("2020-02-27", periods=800).strftime("%Y-%m-%d"),
+                "IC_admission": np.arange(800) % 7
+            })
+        }
+        mock_read_csv.side_effect = lambda path, **kwargs: data[path].copy()
+        self.data_manager = DataManager(use_cache=False)
 
     def test_create_patients(self):
         # Verify that patients are correctly created from the mocked data
@@ -87,6 +357,37 @@ class TestDataManager(unittest.TestCase):
         self.assertTrue(all("ref_spec" in patient for patient in patients))
         self.assertTrue(all("age" in patient for patient in patients))
 
+    def test_data_cache(self):
+        # Verify the on-disk cache survives a touched source file but not a changed one, and that models share the data
+        self.assertIs(DataManager().patient_sampler, DataManager().patient_sampler)
+
+        with tempfile.TemporaryDirectory() as folder:
+            sources = { name: shutil.copy(path, folder) for name, path in SOURCE_FILES.items() }
+            with patch.dict("lib.utils.SOURCE_FILES", sources), patch("lib.utils.CACHE_FILE", os.path.join(folder, "cache.npz")):
+                self.assertIsNone(read_cache())
+                write_cache(DataManager(use_cache=False).preprocess_data())
+                self.assertEqual(list(read_cache()["specs"]), sorted(self.data_manager.OPTIONS.keys()))
+
+                os.utime(sources["opnames"], ns=(0, 0))
+                self.assertIsNotNone(read_cache())
+
+                with open(sources["opnames"], "a") as file:
+                    file.write("\n")
+                self.assertIsNone(read_cache())
+
+    def test_export_and_attach_data(self):
+        # Verify attached DataManagers use read-only memory maps of the exported columns
+        with tempfile.TemporaryDirectory() as folder, patch.dict(DataManager.shared, clear=True):
+            self.data_manager.export_data(folder)
+            DataManager.attach_data(folder)
+            data_manager = DataManager()
+
+            self.assertIsInstance(data_manager.columns["los_icu"], np.memmap)
+            self.assertFalse(data_manager.columns["los_icu"].flags.writeable)
+            self.assertTrue(np.shares_memory(data_manager.patient_sampler.los_values[0], data_manager.columns["los_icu"]))
+            np.testing.assert_array_equal(data_manager.daily_profile, self.data_manager.daily_profile)
+            del data_manager
+
 class TestClock(unittest.TestCase):
     def setUp(self):
         # Initialize a clock with a speed of 1 second = 1 minute
@@ -97,6 +398,14 @@ class TestClock(unittest.TestCase):
         self.clock.add_second()
         self.assertEqual(self.clock.get_day_timestamp(), 60)
 
+    def test_leap_year(self):
+        # Verify the calendar fields follow leap years when advancing by arbitrary amounts of seconds
+        self.clock.advance((365 * 3 + 58) * 24 * 3600 + 90)
+        self.assertEqual(self.clock.get_time(True), "2028/02/28 00:01:30")
+        self.clock.advance(24 * 3600)
+        self.assertEqual((self.clock.month, self.clock.day, self.clock.day_index, self.clock.days_in_year), (2, 29, 60, 366))
+        self.assertEqual(self.clock.format_time(0, False), "01/01/25 00:00:00")
+
 class TestPatient(unittest.TestCase):
     def setUp(self):
         # Mock the model for testing Patient functionality
@@ -155,8 +464,10 @@ class TestReschedulePatients(unittest.TestCase):
         # Create a mock model and Frontdesk for rescheduling tests
         self.model = MagicMock()
         self.model.clock.day_index = 1
+        self.model.clock.days_in_year = 365
         self.model.clock.get_day_timestamp.return_value = 86400
-        self.model.agent_schedules = {1: np.array([86400, 172800])}
+        self.model.agent_schedules = ArrivalSchedule(365)
+        self.model.agent_schedules[1] = np.array([86400, 172800])
         self.model.get_icu_department.return_value = MagicMock()
 
         # Create a mock Patient and Frontdesk
@@ -170,28 +481,165 @@ class TestReschedulePatients(unittest.TestCase):
     def test_reschedule_patient_24(self):
         # Test rescheduling a patient exactly 24 hours later
         index = 2
-        if index not in self.model.agent_schedules:
-            self.model.agent_schedules[index] = []
-
         self.frontdesk.reschedule_patient_24(self.patient)
         self.assertTrue(len(self.model.agent_schedules[index]) > 0)
 
     def test_reschedule_patient_random(self):
         # Test rescheduling a patient to a random day
         random_day = 11
-        if random_day not in self.model.agent_schedules:
-            self.model.agent_schedules[random_day] = []
-
+        self.model.streams["rescheduling"].integers.return_value = random_day
         self.frontdesk.reschedule_patient_random(self.patient)
         self.assertTrue(len(self.model.agent_schedules[random_day]) > 0)
 
     def test_reschedule_patient_lowest(self):
         # Test rescheduling a patient to the day with the least appointments
-        self.model.agent_schedules = {1: np.array([86400]), 2: np.array([172800]), 3: np.array([])}
+        self.model.agent_schedules = ArrivalSchedule(365)
+        for day in range(1, 8):
+            self.model.agent_schedules[day] = [86400] if day != 3 else []
         self.frontdesk.reschedule_patient_lowest(self.patient)
 
         self.patient.remove.assert_called_once()
         self.assertIn(self.model.clock.get_day_timestamp(), self.model.agent_schedules[3])
 
+class TestArrivalSchedule(unittest.TestCase):
+    def test_release_due_arrivals(self):
+        # Test if every due arrival is released at once and arrivals added to today come after the released ones
+        schedule = ArrivalSchedule.from_counts(np.array([4, 1]), np.array([5000, 20, 10, 30, 40]), np.array([False, True, False, False, True]))
+        self.assertEqual(list(schedule[1]), [10, 20, 30, 5000])
+
+        self.assertEqual(list(schedule.release(1, 600)), [False, True, False])
+        self.assertEqual(schedule.count(1), 1)
+        self.assertEqual(len(schedule.release(1, 600)), 0)
+
+        schedule.insert(1, 600, True)
+        self.assertEqual(list(schedule.release(1, 1200)), [True])
+        self.assertEqual(list(schedule[2]), [40])
+
+class TestColumnarDataCollector(unittest.TestCase):
+    def test_table_columns(self):
+        # Test if rows are stored as codes and seconds, grow past the initial size and come back as the original values
+        clock = Clock()
+        datacollector = ColumnarDataCollector(tables={ "refused": { "date": "time", "ref_spec": "category", "age": np.int64 } }, time_formatter=clock.format_time)
+        for i in range(3000):
+            datacollector.add_table_row("refused", { "date": i * 3600, "ref_spec": ["CARD", "NEU"][i % 2], "age": i })
+
+        columns = datacollector.get_table_columns("refused")
+        self.assertEqual(columns["ref_spec"].dtype, np.int16)
+        self.assertEqual(list(columns["ref_spec"][:3]), [0, 1, 0])
+
+        dataframe = datacollector.get_table_dataframe("refused")
+        self.assertEqual(len(dataframe), 3000)
+        self.assertEqual(list(dataframe["ref_spec"][:2]), ["CARD", "NEU"])
+        self.assertEqual(dataframe["date"][25], "2025/01/02 01:00:00")
+        self.assertEqual(dataframe["age"][2999], 2999)
+
+    def test_results_file(self):
+        # Test if a run written to the compact result format is read back into the same tables
+        model = ICUModel(seed=1, size=10, amount=2200, capacity=5, event_driven=True, headless=True)
+        model.run_for_days(2)
+        tables = ["admissions", "costs", "capacity", "waiting"]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "replication0.npz")
+            save_results(path, export_tables(model.datacollector, tables), { "seed": 1, "start_year": 2025 })
+            loaded, metadata = load_results(path)
+            seconds, _ = load_results(path, format_dates=False)
+
+        self.assertEqual(metadata["seed"], 1)
+        for table in tables:
+            pd.testing.assert_frame_equal(loaded[table], model.datacollector.get_table_dataframe(table))
+        self.assertEqual(seconds["costs"]["date"][0], 3600)
+
+class TestReplication(unittest.TestCase):
+    def test_running_statistics(self):
+        # Verify the online mean and variance match numpy on the same values
+        values = [3.0, 7.5, 1.25, 9.0, 4.0]
+        statistics = RunningStatistics()
+        for value in values:
+            statistics.add(value)
+
+        self.assertAlmostEqual(statistics.mean, np.mean(values))
+        self.assertAlmostEqual(statistics.variance, np.var(values, ddof=1))
+
+    def test_aggregator_converges(self):
+        # Verify a parameter set only converges once it has enough replications with a narrow interval
+        aggregator = ReplicationAggregator(confidence=0.95, precision=0.05, min_replications=3)
+        aggregator.add({ "refused": 10.0 })
+        aggregator.add({ "refused": 10.2 })
+        self.assertFalse(aggregator.is_converged())
+
+        aggregator.add({ "refused": 9.9 })
+        self.assertTrue(aggregator.is_converged())
+
+        aggregator.add({ "refused": 30.0 })
+        self.assertFalse(aggregator.is_converged())
+
+        # The interval uses the t quantile, at 3 replications that's 4.303 instead of the normal 1.96
+        statistics = RunningStatistics()
+        for value in [1.0, 2.0, 3.0]:
+            statistics.add(value)
+        self.assertAlmostEqual(statistics.get_half_width(0.95), 4.303 / np.sqrt(3))
+
+        # KPIs that were always zero don't decide the stop on their own
+        aggregator = ReplicationAggregator(confidence=0.95, precision=0.05, min_replications=3)
+        for _ in range(3):
+            aggregator.add({ "refused_NEU": 0.0 })
+        self.assertFalse(aggregator.is_converged())
+
+class TestCapacityOptimizer(unittest.TestCase):
+    def test_optimize(self):
+        # Verify the optimizer finds the smallest capacity and the split that matches a known need of beds per group
+        needs = np.array([5, 10, 5])
+        def evaluate(runs):
+            results = []
+            for candidate, _ in runs:
+                beds = np.floor(candidate.capacity * np.array(candidate.distribution)).astype(int)
+                results.append({ "refusal_rate": np.maximum(needs - beds, 0).sum() / 100, "cumulative_costs": float(np.maximum(beds - needs, 0).sum()) })
+            return results
+
+        optimizer = CapacityOptimizer(evaluate, seeds=[1, 2, 3, 4, 5], target=0)
+        result = optimizer.optimize(3, 64, [1 / 3] * 3)
+        self.assertEqual(result["capacity"], 20)
+        self.assertEqual(result["beds"], [5, 10, 5])
+        self.assertTrue(result["feasible"])
+
+        # Candidates that are clearly decided were stopped early
+        candidates = optimizer.get_candidates_dataframe()
+        self.assertEqual(candidates["replications"].min(), 3)
+        self.assertLess(candidates["replications"].sum(), 5 * len(candidates))
+        self.assertEqual(int(31 * beds_to_distribution([11, 9, 11])[1]), 9)
+
+    def test_pareto_front(self):
+        # Verify only the candidates that no other candidate beats on both objectives remain
+        candidates = pd.DataFrame({ "refusal_rate": [0.1, 0.2, 0.05, 0.2], "cumulative_costs": [10, 5, 20, 10] })
+        front = get_pareto_front(candidates)
+        self.assertEqual(front["refusal_rate"].tolist(), [0.05, 0.1, 0.2])
+        self.assertEqual(front["cumulative_costs"].tolist(), [20, 10, 5])
+
+class TestBenchmark(unittest.TestCase):
+    def test_matrix_and_comparison(self):
+        # Verify every layout is crossed with the given values and only metrics that got worse beyond the tolerance are flagged
+        config = [
+            { "departments": [["CAPU"]], "distribution": [1], "is_specialized": [False], "amount": 2200, "capacity": 32, "clock_speed": 10 },
+            { "departments": [["CAPU"]], "distribution": [1], "is_specialized": [False], "amount": 4500, "capacity": 32, "clock_speed": 10 },
+            { "departments": [["CAPU"], ["NEU"]], "distribution": [0.5, 0.5], "is_specialized": [False, False], "amount": 2200, "capacity": 32, "clock_speed": 10 }
+        ]
+        self.assertEqual(len(create_matrix(config)), 3)
+        self.assertEqual(len(create_matrix(config, capacities=[16, 32, 64])), 9)
+
+        baseline = { "results": [{ "key": "a", "metrics": { "run_seconds": 1.0, "steps_per_second": 100.0 }, "components": { "frontdesk_step": 1e-6, "datamanager_mean_std_by_planned": 1e-7 } }] }
+        current = { "results": [{ "key": "a", "metrics": { "run_seconds": 1.05, "steps_per_second": 50.0 }, "components": { "frontdesk_step": 2e-6, "datamanager_mean_std_by_planned": 2e-7 } }] }
+        comparison = compare_results(baseline, current, tolerance=0.1).set_index("metric")
+
+        self.assertFalse(comparison.loc["run_seconds", "regression"])
+        self.assertTrue(comparison.loc["steps_per_second", "regression"])
+        self.assertTrue(comparison.loc["components.frontdesk_step", "regression"])
+        self.assertFalse(comparison.loc["components.datamanager_mean_std_by_planned", "regression"])
+
+        # A machine that is twice as slow as a whole isn't a regression
+        current = { "results": [{ "key": "a", "calibration_seconds": 2.0, "metrics": { "run_seconds": 2.0, "steps_per_second": 50.0 } }] }
+        comparison = compare_results({ "results": [{ **baseline["results"][0], "calibration_seconds": 1.0 }] }, current, tolerance=0.1)
+        self.assertFalse(comparison["regression"].any())
+
 if __name__ == '__main__':
     unittest.main()